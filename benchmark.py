@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import argparse
+
+from pipeline.benchmark import BenchmarkRunner, compare
+from pipeline.synthetic import query_extent, generate_las
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import and query suites in scripts/.')
+    parser.add_argument('--query', type=str, default=None, help='Query parameter json file path.')
+    parser.add_argument('--import', dest='import_', type=str, default=None, help='Import parameter json file path.')
+    parser.add_argument('--password', type=str, default="123456", help='Database password.')
+    parser.add_argument('--backend', type=str, default="postgres", choices=["postgres", "local"], help='Storage backend.')
+    parser.add_argument('--store', type=str, default="./store", help='Root directory of the local block store.')
+    parser.add_argument('--server-decode', action='store_true', help='Decode the points inside PostgreSQL.')
+    parser.add_argument('--profile', type=str, default=None, choices=["default", "bulk"], help='PostgreSQL load profile.')
+    parser.add_argument('--warmup', type=int, default=1, help='Warm-up runs per entry, not in the summary.')
+    parser.add_argument('--repeat', type=int, default=3, help='Measured runs per entry.')
+    parser.add_argument('--export', action='store_true', help='Also export the query results to LAS files.')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Generate a synthetic LAS file with this many points covering the query suite, and import it.')
+    parser.add_argument('--output', type=str, default="./bench/results", help='Prefix of the result .json and .csv files.')
+    parser.add_argument('--baseline', type=str, default=None, help='Result .json file of a previous run to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown flagged as a regression.')
+    args = parser.parse_args()
+
+    if not args.query and not args.import_:
+        print("ERROR: Give a query suite, an import suite or both.")
+        sys.exit(1)
+
+    try:
+        query_params = load_json(args.query) if args.query else None
+        import_params = load_json(args.import_) if args.import_ else None
+    except FileNotFoundError:
+        print("ERROR: File not found.")
+        sys.exit(1)
+    except json.JSONDecodeError as e:
+        print(f"ERROR: JSON decoding error: {e}")
+        sys.exit(1)
+
+    db_conf = (import_params or query_params)["config"]
+    db_conf["password"] = args.password
+    db_conf["backend"] = args.backend
+    db_conf["store_dir"] = args.store
+    db_conf["server_decode"] = args.server_decode
+    if args.profile:
+        db_conf["profile"] = args.profile
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    imports = import_params["imports"] if import_params else {}
+    if args.synthetic and query_params:
+        # Replace the imports by synthetic files covering the queries
+        imports = {}
+        for name, bbox in query_extent(query_params["queries"]).items():
+            path = os.path.join(os.path.dirname(os.path.abspath(args.output)), f"synthetic_{name}.las")
+            generate_las(path, bbox, args.synthetic)
+            imports[name] = {"mode": "file", "srid": 28992, "path": path, "ratio": 0.7}
+
+    runner = BenchmarkRunner(db_conf, warmup=args.warmup, repeat=args.repeat, export=args.export)
+    if imports:
+        runner.run_imports(imports)
+    if query_params:
+        runner.run_queries(query_params["queries"])
+    runner.write_results(args.output)
+
+    if args.baseline:
+        regressions = compare(runner.summary(), args.baseline, args.threshold)
+        for key, baseline, current, ratio in regressions:
+            print(f"REGRESSION {key}: {baseline}s -> {current}s ({ratio:.2f}x)")
+        if regressions:
+            sys.exit(1)
+
+
+def load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    main()
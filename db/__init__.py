@@ -1,17 +1,48 @@
+import os
+import time
+import numpy as np
 from psycopg2 import connect, Error, extras
 
+from db.backend import Backend, METADATA_FIELDS, check_dataset_name, lod_head_ranges
+from db.block_store import BlockStore
+from db.server_decode import DECODE_FUNCTIONS_SQL, decode_functions_installed
+from pcsfc.instrument import traced, count
 
-class Postgres:
-    def __init__(self, db_conf, name):
+
+class Postgres(Backend):
+    unlogged = False
+
+    def __init__(self, db_conf, name, lod=None):
+        """
+        Args:
+            lod: read the level of detail of this depth instead of the full points
+        """
         self.db_conf = db_conf
+        self.name = check_dataset_name(name)
         self.connection = None
         self.cursor = None
+        self.owns_connection = True
+        self.merged_heads = None
 
         self.meta_table = "metadata_1m_" + name
         self.point_table = "point_1m_" + name
+        self.staging_table = "staging_1m_" + name
         self.btree_index = "btree_1m_idx_" + name
+        self.lod_meta_table = "lod_1m_" + name
+        if lod:
+            self.point_table = self.lod_table(lod)
+
+    def connect(self, connection=None):
+        """
+        Args:
+            connection: an open psycopg2 connection to use, it is left open by disconnect()
+        """
+        if connection is not None:
+            self.connection = connection
+            self.cursor = connection.cursor()
+            self.owns_connection = False
+            return
 
-    def connect(self):
         try:
             self.connection = connect(
                 dbname=self.db_conf["dbname"],
@@ -28,7 +59,8 @@ class Postgres:
     def disconnect(self):
         if self.connection:
             self.cursor.close()
-            self.connection.close()
+            if self.owns_connection:
+                self.connection.close()
             self.connection = None
             self.cursor = None
 
@@ -49,7 +81,7 @@ class Postgres:
                 offsets DOUBLE PRECISION[],
                 bbox DOUBLE PRECISION[]
             );        
-            CREATE TABLE IF NOT EXISTS {self.point_table} (
+            CREATE {"UNLOGGED " if self.unlogged else ""}TABLE IF NOT EXISTS {self.point_table} (
                 sfc_head INT,
                 sfc_tail INT[],
                 z DOUBLE PRECISION[]
@@ -62,6 +94,17 @@ class Postgres:
             print("Error: Unable to create table")
             print(e)
             self.connection.rollback()
+        self.create_decode_functions()
+
+    def create_decode_functions(self):
+        # The SQL functions of query.py --server-decode, installed once per database
+        if not decode_functions_installed(self.cursor):
+            self.execute_sql(DECODE_FUNCTIONS_SQL)
+
+    def drop_tables(self):
+        lod_tables = "".join(f", {self.lod_table(depth)}" for depth in self.read_lod())
+        self.execute_sql(f"DROP TABLE IF EXISTS {self.meta_table}, {self.point_table}, {self.staging_table}, "
+                         f"{self.lod_meta_table}{lod_tables};")
 
     def execute_sql(self, sql, data=None):
         if not self.connection:
@@ -91,20 +134,197 @@ class Postgres:
             print(e)
             self.connection.rollback()
 
-    def copy_points(self, file="pc_record.csv"):
+    def read_metadata(self):
+        try:
+            self.cursor.execute(f"SELECT * FROM {self.meta_table} LIMIT 1;")
+            row = self.cursor.fetchone()
+        except Error:
+            self.connection.rollback()
+            return None
+        return dict(zip(METADATA_FIELDS, row)) if row else None
+
+    def update_metadata(self, data):
+        if not self.connection:
+            print("Error: Database connection is not established.")
+            return
+
+        meta = dict(zip(METADATA_FIELDS, data))
+        bbox = meta["bbox"]
+        sql = f"""
+            UPDATE {self.meta_table} SET
+                point_count = point_count + %s,
+                head_length = GREATEST(head_length, %s),
+                bbox = ARRAY[LEAST(bbox[1], %s), GREATEST(bbox[2], %s), LEAST(bbox[3], %s),
+                             GREATEST(bbox[4], %s), LEAST(bbox[5], %s), GREATEST(bbox[6], %s)]
+            WHERE name = %s
+            """
+        try:
+            self.cursor.execute(sql, [meta["point_count"], meta["head_length"]] + [float(v) for v in bbox] + [meta["name"]])
+            self.connection.commit()
+        except Error as e:
+            print(f"Error: Unable to update metadata.")
+            print(e)
+            self.connection.rollback()
+
+    @traced()
+    def copy_points(self, file="pc_record.csv", table=None):
         if not self.connection:
             print("Error: Database connection is not established.")
             return
 
+        table = table or self.point_table
+        count("bytes", os.path.getsize(file))
         with open(file, 'r') as f:
             try:
-                self.cursor.copy_expert(sql=f"COPY {self.point_table} FROM stdin WITH CSV HEADER", file=f)
+                self.cursor.copy_expert(sql=f"COPY {table} FROM stdin WITH CSV HEADER", file=f)
                 self.connection.commit()
             except Error as e:
                 print("Error: Unable to copy the data.")
                 print(e)
                 self.connection.rollback()
 
+    def stage_points(self, file="pc_record.csv"):
+        self.execute_sql(f"CREATE UNLOGGED TABLE IF NOT EXISTS {self.staging_table} (LIKE {self.point_table});")
+        self.copy_points(file, table=self.staging_table)
+
+    def merge_staging(self):
+        """
+        Set-based upsert of the staged blocks: only the blocks whose head is staged are
+        deleted, merged with the staged points, re-sorted by tail and inserted again.
+        The other blocks and the btree index are left as they are.
+        The staged heads are kept in merged_heads for build_lod.
+        """
+        sql = f"""
+            WITH staged_heads AS (
+                SELECT DISTINCT sfc_head FROM {self.staging_table}
+            ), old_blocks AS (
+                DELETE FROM {self.point_table} p USING staged_heads s
+                WHERE p.sfc_head = s.sfc_head
+                RETURNING p.*
+            ), points AS (
+                SELECT sfc_head, unnest(sfc_tail) AS sfc_tail, unnest(z) AS z FROM old_blocks
+                UNION ALL
+                SELECT sfc_head, unnest(sfc_tail) AS sfc_tail, unnest(z) AS z FROM {self.staging_table}
+            )
+            INSERT INTO {self.point_table} (sfc_head, sfc_tail, z)
+            SELECT sfc_head, array_agg(sfc_tail ORDER BY sfc_tail), array_agg(z ORDER BY sfc_tail)
+            FROM points
+            GROUP BY sfc_head;
+            DROP TABLE {self.staging_table};
+            """
+        self.cursor.execute(f"SELECT DISTINCT sfc_head FROM {self.staging_table};")
+        self.merged_heads = np.array([row[0] for row in self.cursor.fetchall()], dtype=np.int64)
+        self.execute_sql(sql)
+
+    def lod_table(self, depth):
+        return f"lod{int(depth)}_1m_{self.name}"
+
+    def open_lod(self, depth):
+        level = Postgres(self.db_conf, self.name, lod=depth)
+        level.connect(self.connection)
+        return level
+
+    def read_lod(self):
+        self.cursor.execute("SELECT to_regclass(%s);", (self.lod_meta_table,))
+        if self.cursor.fetchone()[0] is None:
+            return {}
+        self.cursor.execute(f"SELECT depth, point_count FROM {self.lod_meta_table} ORDER BY depth;")
+        return dict(self.cursor.fetchall())
+
+    def build_lod(self, depths, heads=None):
+        """
+        Every level is a table with the same columns as the point table, thinned from the
+        previous level head by head, see thin_sql, so no statement sorts the whole table.
+        With heads, only the rows of the cells holding these heads are deleted and thinned
+        again, in one statement per level which also updates its point count.
+        """
+        tail_len = self.read_metadata()["tail_length"]
+        levels = self.read_lod()
+        if heads is None or sorted(levels) != sorted(depths):
+            self.rebuild_lod(depths, tail_len)
+            return
+
+        source_table = self.point_table
+        for depth in sorted(depths):
+            start_time = time.time()
+            table = self.lod_table(depth)
+            self.cursor.execute("DROP TABLE IF EXISTS LodRangeTable")
+            self.cursor.execute("CREATE TEMP TABLE LodRangeTable (range_start INT, range_end INT)")
+            extras.execute_values(self.cursor, "INSERT INTO LodRangeTable (range_start, range_end) VALUES %s",
+                                  [(int(start), int(end)) for start, end in lod_head_ranges(heads, depth, tail_len)])
+            in_ranges = "EXISTS (SELECT 1 FROM LodRangeTable r WHERE p.sfc_head BETWEEN r.range_start AND r.range_end)"
+            self.execute_sql(f"""
+                WITH removed AS (
+                    DELETE FROM {table} p WHERE {in_ranges}
+                    RETURNING cardinality(p.sfc_tail) AS n
+                ), added AS (
+                    INSERT INTO {table} (sfc_head, sfc_tail, z)
+                    {self.thin_sql(source_table, depth, tail_len, in_ranges)}
+                    RETURNING cardinality(sfc_tail) AS n
+                )
+                UPDATE {self.lod_meta_table}
+                SET point_count = point_count + (SELECT coalesce(sum(n), 0) FROM added) - (SELECT coalesce(sum(n), 0) FROM removed)
+                WHERE depth = {depth};
+                DROP TABLE LodRangeTable;
+                """)
+            print(f"-> LOD {depth} time:", round(time.time() - start_time, 2))
+            source_table = table
+
+    def rebuild_lod(self, depths, tail_len):
+        old_tables = "".join(f", {self.lod_table(depth)}" for depth in self.read_lod())
+        self.execute_sql(f"""
+            DROP TABLE IF EXISTS {self.lod_meta_table}{old_tables};
+            CREATE TABLE {self.lod_meta_table} (depth INT, point_count BIGINT);
+            """)
+
+        source_table = self.point_table
+        for depth in sorted(depths):
+            start_time = time.time()
+            table = self.lod_table(depth)
+            self.execute_sql(f"""
+                CREATE TABLE {table} AS
+                {self.thin_sql(source_table, depth, tail_len)};
+                CREATE INDEX ON {table} USING btree (sfc_head);
+                INSERT INTO {self.lod_meta_table}
+                SELECT {depth}, coalesce(sum(cardinality(sfc_tail)), 0) FROM {table};
+                """)
+            print(f"-> LOD {depth} time:", round(time.time() - start_time, 2))
+            source_table = table
+
+    @staticmethod
+    def thin_sql(source_table, depth, tail_len, where="TRUE"):
+        """
+        One block per head of the level: the point with the smallest key of every cell of
+        2^depth x 2^depth units. A cell inside one head (2 * depth <= tail_len) is thinned
+        from the rows of that head only, sorting one head at a time. A cell spanning several
+        heads keeps the first tail of its smallest head, found by a hash aggregate.
+        """
+        shift = 2 * depth - tail_len
+        if shift <= 0:
+            return f"""
+                SELECT h.sfc_head, c.sfc_tail, c.z
+                FROM (SELECT DISTINCT sfc_head FROM {source_table} p WHERE {where}) h
+                CROSS JOIN LATERAL (
+                    SELECT array_agg(sfc_tail ORDER BY sfc_tail) AS sfc_tail, array_agg(z ORDER BY sfc_tail) AS z
+                    FROM (
+                        SELECT DISTINCT ON (u.sfc_tail >> {2 * depth}) u.sfc_tail, u.z
+                        FROM {source_table} b
+                        CROSS JOIN LATERAL unnest(b.sfc_tail, b.z) AS u(sfc_tail, z)
+                        WHERE b.sfc_head = h.sfc_head
+                        ORDER BY u.sfc_tail >> {2 * depth}, u.sfc_tail
+                    ) AS cells
+                ) c"""
+        return f"""
+            SELECT h.sfc_head, c.sfc_tail, c.z
+            FROM (SELECT min(sfc_head) AS sfc_head FROM {source_table} p WHERE {where} GROUP BY sfc_head >> {shift}) h
+            CROSS JOIN LATERAL (
+                SELECT b.sfc_tail[1:1] AS sfc_tail, b.z[1:1] AS z
+                FROM {source_table} b
+                WHERE b.sfc_head = h.sfc_head
+                ORDER BY b.sfc_tail[1]
+                LIMIT 1
+            ) c"""
+
     def execute_query(self, data, name="default"):
         sql = f"SELECT * FROM {self.point_table} WHERE sfc_head IN %(data)s"
         self.cursor.execute(sql, {'data': tuple(data)})
@@ -113,8 +333,28 @@ class Postgres:
         for row in results:
             print(row)
 
+    def fetch_ranges(self, ranges, exclude=()):
+        self.cursor.execute('DROP TABLE IF EXISTS RangeTable')
+        self.cursor.execute('''CREATE TEMP TABLE RangeTable (range_start INT, range_end INT)''')
+        extras.execute_values(self.cursor, 'INSERT INTO RangeTable (range_start, range_end) VALUES %s',
+                              [(int(start), int(end)) for start, end in ranges], page_size=10000)
+
+        exclude_sql = f"AND NOT ({self.point_table}.sfc_head = ANY(%(exclude)s))" if len(exclude) > 0 else ""
+        self.cursor.execute(f'''
+            SELECT * FROM {self.point_table}
+            WHERE EXISTS (
+                SELECT 1 FROM RangeTable
+                WHERE {self.point_table}.sfc_head BETWEEN RangeTable.range_start AND RangeTable.range_end
+            ) {exclude_sql}
+        ''', {'exclude': [int(head) for head in exclude]})
+        return self.cursor.fetchall()
+
+    def fetch_heads(self, heads):
+        self.cursor.execute(f'''SELECT * FROM {self.point_table} WHERE sfc_head = ANY(%s)''', ([int(head) for head in heads],))
+        return self.cursor.fetchall()
+
     def create_btree_index(self, name="default"):
-        sql = f"CREATE INDEX {self.btree_index} ON {self.point_table} USING btree (sfc_head)"
+        sql = f"CREATE INDEX IF NOT EXISTS {self.btree_index} ON {self.point_table} USING btree (sfc_head)"
         try:
             self.cursor.execute(sql)
             self.connection.commit()
@@ -122,3 +362,56 @@ class Postgres:
             print(f"Error: Unable to execute query: {sql}")
             print(e)
             self.connection.rollback()
+
+
+class BulkLoadPostgres(Postgres):
+    """
+    Bulk-load profile: the points are copied into an UNLOGGED table, and closing the
+    load builds the btree index with more memory and parallel workers, orders the rows
+    by sfc_head, adds a BRIN index, collects planner statistics and only then makes
+    the table LOGGED.
+    """
+    unlogged = True
+
+    def __init__(self, db_conf, name):
+        super().__init__(db_conf, name)
+        self.brin_index = "brin_1m_idx_" + name
+        self.maintenance_work_mem = db_conf.get("maintenance_work_mem", "1GB")
+        self.parallel_workers = db_conf.get("parallel_maintenance_workers", 4)
+
+    def create_btree_index(self, name="default"):
+        start_time = time.time()
+        self.execute_sql(f"""
+            SET maintenance_work_mem = '{self.maintenance_work_mem}';
+            SET max_parallel_maintenance_workers = {self.parallel_workers};
+            """)
+        super().create_btree_index(name)
+        btree_time = time.time()
+        print("-> Btree index time:", round(btree_time - start_time, 2))
+
+        self.execute_sql(f"CLUSTER {self.point_table} USING {self.btree_index}")
+        cluster_time = time.time()
+        print("-> Cluster time:", round(cluster_time - btree_time, 2))
+
+        self.execute_sql(f"CREATE INDEX IF NOT EXISTS {self.brin_index} ON {self.point_table} USING brin (sfc_head)")
+        self.execute_sql(f"ANALYZE {self.point_table}")
+        analyze_time = time.time()
+        print("-> Brin index and analyze time:", round(analyze_time - cluster_time, 2))
+
+        self.execute_sql(f"ALTER TABLE {self.point_table} SET LOGGED")
+        print("-> Set logged time:", round(time.time() - analyze_time, 2))
+
+
+def get_backend(db_conf, name, append=False):
+    """
+    Pick the storage backend from the configuration: the memory-mapped block
+    store when db_conf["backend"] is "local", PostgreSQL otherwise, with the
+    bulk-load profile when db_conf["profile"] is "bulk". The bulk-load profile
+    is for fresh loads only: appending to a table with it would CLUSTER and
+    ANALYZE the whole table under an exclusive lock for every append.
+    """
+    if db_conf.get("backend") == "local":
+        return BlockStore(db_conf, name)
+    if db_conf.get("profile") == "bulk" and not append:
+        return BulkLoadPostgres(db_conf, name)
+    return Postgres(db_conf, name)
@@ -0,0 +1,164 @@
+import re
+from abc import ABC, abstractmethod
+import numpy as np
+
+METADATA_FIELDS = ["name", "srid", "point_count", "head_length", "tail_length", "scales", "offsets", "bbox"]
+
+# Names that end up in SQL and file paths without quoting: a query name is a table name
+# (folded to lower case by PostgreSQL), a dataset name the suffix of table and directory names
+TABLE_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+DATASET_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+def check_table_name(name):
+    if not isinstance(name, str) or not TABLE_NAME.match(name):
+        raise ValueError(f"Invalid query name: {name!r}, use letters, digits and _, not starting with a digit.")
+    return name
+
+
+def check_dataset_name(name):
+    if not isinstance(name, str) or not DATASET_NAME.match(name):
+        raise ValueError(f"Invalid dataset name: {name!r}, use letters, digits and _.")
+    return name
+
+
+def lod_head_ranges(heads, depth, tail_len):
+    """
+    The [head_start, head_end] ranges of the Morton cells of depth `depth` holding heads.
+    A cell with 2 * depth <= tail_len is inside one head, a larger one spans 2^(2 * depth - tail_len) heads.
+
+    Returns:
+        np.ndarray: (n, 2) sorted, disjoint ranges
+    """
+    shift = max(0, 2 * depth - tail_len)
+    cells = np.unique(np.asarray(heads, dtype=np.int64) >> shift)
+    return np.column_stack((cells << shift, ((cells + 1) << shift) - 1))
+
+
+class Backend(ABC):
+    """
+    Storage backend for the SFC head/tail point blocks.
+
+    A backend stores one row per block: the SFC head, the sorted SFC tails of
+    the points in the block and their z values. Loaders write through
+    create_table / insert_metadata / copy_points / create_btree_index, or append
+    with stage_points / merge_staging / update_metadata, and
+    queriers read blocks back with fetch_ranges / fetch_heads.
+
+    build_lod stores thinned copies of the blocks, with the same layout and
+    keyed by the same SFC heads, for coarse queries and previews.
+    """
+    @abstractmethod
+    def connect(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def disconnect(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_table(self, name="default"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def drop_tables(self):
+        """
+        Remove the stored dataset, metadata included.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert_metadata(self, data):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_metadata(self):
+        """
+        Returns:
+            dict: the stored metadata, keyed by METADATA_FIELDS, None without metadata
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_metadata(self, data):
+        """
+        Add the metadata of newly appended points: point_count is summed, bbox and head_length are widened.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def copy_points(self, file="pc_record.csv"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stage_points(self, file="pc_record.csv"):
+        """
+        Load blocks into the staging area without touching the stored blocks.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def merge_staging(self):
+        """
+        Merge the staged blocks into the stored ones and empty the staging area.
+        The heads of the merged blocks are kept in merged_heads.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_btree_index(self, name="default"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def build_lod(self, depths, heads=None):
+        """
+        Build the level-of-detail pyramid. Level d keeps one point per Morton cell of
+        2^d x 2^d units, the one with the smallest key, and is thinned from the previous
+        level.
+
+        Args:
+            depths: the cell depths of the levels, e.g. [2, 4, 6, 8]
+            heads: only update the cells of these heads, e.g. the merged_heads of
+                merge_staging; the pyramid is built again when it has other depths
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def open_lod(self, depth):
+        """
+        Returns:
+            Backend: a connected backend reading the level of detail of this depth,
+            sharing the connection of this one where there is one
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_lod(self):
+        """
+        Returns:
+            dict: {depth: point_count} of the stored levels, empty without a pyramid
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def fetch_ranges(self, ranges, exclude=()):
+        """
+        Args:
+            ranges: a list of [head_start, head_end] pairs, both ends inclusive
+            exclude: heads to leave out, e.g. blocks the caller has already fetched
+
+        Returns:
+            list: (sfc_head, sfc_tail, z) for every block whose head is in one of the ranges
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def fetch_heads(self, heads):
+        """
+        Args:
+            heads: a list of SFC heads
+
+        Returns:
+            list: (sfc_head, sfc_tail, z) for every block whose head is in heads
+        """
+        raise NotImplementedError
@@ -0,0 +1,370 @@
+import os
+import json
+import shutil
+import numpy as np
+
+from db.backend import Backend, METADATA_FIELDS, check_dataset_name, lod_head_ranges
+from pcsfc.instrument import traced, count
+
+# Blocks read at a time when building a level of detail
+LOD_CHUNK_BLOCKS = 100000
+
+
+class BlockStore(Backend):
+    def __init__(self, db_conf, name, lod=None):
+        """
+        Local on-disk alternative to Postgres. The blocks are stored column by
+        column in .npy files which are memory-mapped when reading:
+            heads.npy    int32, the SFC heads, sorted
+            offsets.npy  int64, block i holds the points offsets[i]:offsets[i+1]
+            tails.npy    int32, the SFC tails, sorted inside each block
+            z.npy        float64, the z values
+            meta.json    the same fields as the metadata table
+            lod.json     {depth: point_count} of the levels of detail in lod<depth>/
+        Args:
+            db_conf: the "config" of the json file, with "store_dir" as the root directory
+            name: the name of the dataset
+            lod: open the level of detail of this depth instead of the full points
+        """
+        self.db_conf = db_conf
+        self.name = check_dataset_name(name)
+        self.store_dir = os.path.join(db_conf["store_dir"], "1m_" + name)
+        if lod:
+            self.store_dir = os.path.join(self.store_dir, f"lod{int(lod)}")
+        self.connection = None
+
+        self.heads = None
+        self.offsets = None
+        self.tails = None
+        self.z = None
+        self.merged_heads = None
+
+    def connect(self):
+        self.connection = self.store_dir
+        if os.path.isfile(self.path("heads.npy")):
+            self.heads = np.load(self.path("heads.npy"), mmap_mode="r")
+            self.offsets = np.load(self.path("offsets.npy"), mmap_mode="r")
+            self.tails = np.load(self.path("tails.npy"), mmap_mode="r")
+            self.z = np.load(self.path("z.npy"), mmap_mode="r")
+
+    def disconnect(self):
+        if self.connection:
+            self.heads = self.offsets = self.tails = self.z = None
+            self.connection = None
+
+    def path(self, file):
+        return os.path.join(self.store_dir, file)
+
+    def create_table(self, name="default"):
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def drop_tables(self):
+        self.disconnect()
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+
+    def insert_metadata(self, data):
+        with open(self.path("meta.json"), "w") as f:
+            json.dump(dict(zip(METADATA_FIELDS, data)), f)
+
+    def read_metadata(self):
+        if not os.path.isfile(self.path("meta.json")):
+            return None
+        with open(self.path("meta.json"), "r") as f:
+            return json.load(f)
+
+    def update_metadata(self, data):
+        meta = self.read_metadata()
+        new = dict(zip(METADATA_FIELDS, data))
+        meta["point_count"] += new["point_count"]
+        meta["head_length"] = max(meta["head_length"], new["head_length"])
+        bbox, new_bbox = meta["bbox"], new["bbox"]
+        meta["bbox"] = [min(bbox[0], new_bbox[0]), max(bbox[1], new_bbox[1]),
+                        min(bbox[2], new_bbox[2]), max(bbox[3], new_bbox[3]),
+                        min(bbox[4], new_bbox[4]), max(bbox[5], new_bbox[5])]
+        with open(self.path("meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @traced()
+    def copy_points(self, file="pc_record.csv"):
+        """
+        Read the blocks written by PointProcessor.write_csv and stage them in
+        staging/part_<n>.npz, until create_btree_index merges them into the store.
+        """
+        import pandas as pd
+
+        count("bytes", os.path.getsize(file))
+        df = pd.read_csv(file)
+        tails = [np.fromstring(s[1:-1], dtype=np.int32, sep=',') for s in df['sfc_tail']]
+        z = [np.fromstring(s[1:-1], dtype=np.float64, sep=',') for s in df['z']]
+
+        staging_dir = self.path("staging")
+        os.makedirs(staging_dir, exist_ok=True)
+        part = os.path.join(staging_dir, f"part_{len(os.listdir(staging_dir))}.npz")
+        np.savez(part,
+                 heads=df['sfc_head'].to_numpy(dtype=np.int32),
+                 sizes=np.array([len(t) for t in tails], dtype=np.int64),
+                 tails=np.concatenate(tails) if tails else np.empty(0, dtype=np.int32),
+                 z=np.concatenate(z) if z else np.empty(0, dtype=np.float64))
+
+    def stage_points(self, file="pc_record.csv"):
+        self.copy_points(file)
+
+    def merge_staging(self):
+        self.create_btree_index()
+
+    def create_btree_index(self, name="default"):
+        """
+        Merge the staged blocks into the store. Staged blocks with the head of a stored
+        block, or of another staged block, become one block with its tails sorted again;
+        only these blocks are decoded and sorted, in memory. The heads of the merged
+        blocks are kept in merged_heads for build_lod.
+        """
+        staging_dir = self.path("staging")
+        parts = sorted(os.listdir(staging_dir), key=lambda f: int(f[5:-4])) if os.path.isdir(staging_dir) else []
+        if not parts:
+            return
+
+        # 1. The staged points, sorted by head and tail, and their blocks
+        heads, sizes, tails, z = [], [], [], []
+        for part in parts:
+            with np.load(os.path.join(staging_dir, part)) as data:
+                heads.append(data["heads"])
+                sizes.append(data["sizes"])
+                tails.append(data["tails"])
+                z.append(data["z"])
+        point_heads = np.repeat(np.concatenate(heads), np.concatenate(sizes))
+        tails, z = np.concatenate(tails), np.concatenate(z)
+        order = np.lexsort((tails, point_heads))
+        point_heads, tails, z = point_heads[order], tails[order], z[order]
+        new_heads, new_starts, new_sizes = np.unique(point_heads, return_index=True, return_counts=True)
+        self.merged_heads = new_heads
+
+        # 2. Merge them with the stored blocks of the same heads
+        old_heads, old_offsets, old_tails, old_z = self.columns()
+        lows = np.searchsorted(old_heads, new_heads, side="left")
+        highs = np.searchsorted(old_heads, new_heads, side="right")
+        edits = []
+        for head, start, size, low, high in zip(new_heads, new_starts, new_sizes, lows, highs):
+            old_start, old_end = int(old_offsets[low]), int(old_offsets[high])
+            block_tails = np.concatenate((old_tails[old_start:old_end], tails[start:start + size]))
+            block_z = np.concatenate((old_z[old_start:old_end], z[start:start + size]))
+            tail_order = np.argsort(block_tails, kind="stable")
+            edits.append((low, high, [(head, block_tails[tail_order], block_z[tail_order])]))
+        del old_heads, old_offsets, old_tails, old_z
+
+        self.rewrite_blocks(edits)
+        for part in parts:
+            os.remove(os.path.join(staging_dir, part))
+
+    def columns(self):
+        # The mapped heads, offsets, tails and z, empty arrays for an empty store
+        if self.heads is not None:
+            return self.heads, self.offsets, self.tails, self.z
+        return (np.empty(0, dtype=np.int32), np.zeros(1, dtype=np.int64),
+                np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64))
+
+    def rewrite_blocks(self, edits):
+        """
+        Replace the stored blocks low:high by new blocks, for every (low, high, blocks) of
+        edits, sorted by low and not overlapping; blocks is a list of (head, tails, z) in
+        head order. The other stored blocks are copied unchanged, in runs, from the mapped
+        columns into new column files, since a column file cannot grow in the middle: the
+        copy is sequential I/O over the whole store, but memory and sorting follow the
+        edited blocks.
+        """
+        old_heads, old_offsets, old_tails, old_z = self.columns()
+        block_count = len(old_heads) + sum(len(blocks) - (high - low) for low, high, blocks in edits)
+        point_count = int(old_offsets[-1]) + sum(sum(len(tails) for _, tails, _ in blocks)
+                                                 - int(old_offsets[high] - old_offsets[low])
+                                                 for low, high, blocks in edits)
+        columns = {file: np.lib.format.open_memmap(self.path("tmp_" + file), mode="w+", dtype=dtype, shape=(n,))
+                   for file, dtype, n in [("heads.npy", np.int32, block_count), ("offsets.npy", np.int64, block_count + 1),
+                                          ("tails.npy", np.int32, point_count), ("z.npy", np.float64, point_count)]}
+        out_heads, out_offsets, out_tails, out_z = (columns[file] for file in ["heads.npy", "offsets.npy", "tails.npy", "z.npy"])
+        out_offsets[0] = 0
+        block_pos, point_pos, old_pos = 0, 0, 0
+
+        def copy_old_blocks(end):
+            nonlocal block_pos, point_pos
+            n, start_point, end_point = end - old_pos, int(old_offsets[old_pos]), int(old_offsets[end])
+            out_heads[block_pos:block_pos + n] = old_heads[old_pos:end]
+            out_offsets[block_pos + 1:block_pos + n + 1] = old_offsets[old_pos + 1:end + 1] - start_point + point_pos
+            out_tails[point_pos:point_pos + end_point - start_point] = old_tails[start_point:end_point]
+            out_z[point_pos:point_pos + end_point - start_point] = old_z[start_point:end_point]
+            block_pos += n
+            point_pos += end_point - start_point
+
+        for low, high, blocks in edits:
+            copy_old_blocks(low)
+            for head, tails, z in blocks:
+                n = len(tails)
+                out_heads[block_pos] = head
+                out_tails[point_pos:point_pos + n] = tails
+                out_z[point_pos:point_pos + n] = z
+                out_offsets[block_pos + 1] = point_pos + n
+                block_pos += 1
+                point_pos += n
+            old_pos = high
+        copy_old_blocks(len(old_heads))
+
+        for array in columns.values():
+            array.flush()
+        del columns, out_heads, out_offsets, out_tails, out_z, old_heads, old_offsets, old_tails, old_z
+        self.disconnect()
+        for file in ["heads.npy", "offsets.npy", "tails.npy", "z.npy"]:
+            os.replace(self.path("tmp_" + file), self.path(file))
+        self.connect()
+
+    def write_columns(self, heads, offsets, tails, z):
+        self.disconnect()
+        for file, array in [("heads.npy", heads), ("offsets.npy", offsets), ("tails.npy", tails), ("z.npy", z)]:
+            np.save(self.path("tmp_" + file), array)
+            os.replace(self.path("tmp_" + file), self.path(file))
+        self.connect()
+
+    def build_lod(self, depths, heads=None):
+        """
+        The blocks are sorted by head and their tails are sorted, so the keys of the store
+        are sorted and every Morton cell is a run of keys. Without heads, the levels are
+        built again, streaming over the blocks in chunks that end on a cell boundary; only
+        the level being built is held in memory. With heads, the heads of appended blocks,
+        only the cells of these heads are thinned again and replaced in every level.
+        """
+        tail_len = self.read_metadata()["tail_length"]
+        levels = self.read_lod()
+        if heads is None or sorted(levels) != sorted(depths):
+            self.rebuild_lod(depths, tail_len)
+            return
+
+        source = self
+        for depth in sorted(depths):
+            ranges = lod_head_ranges(heads, depth, tail_len)
+            new_heads, new_offsets, new_tails, new_z = thin_blocks(source.fetch_ranges(ranges), depth, tail_len)
+
+            level = self.open_lod(depth)
+            level_heads, level_offsets = level.columns()[:2]
+            lows = np.searchsorted(level_heads, ranges[:, 0], side="left")
+            highs = np.searchsorted(level_heads, ranges[:, 1], side="right")
+            new_lows = np.searchsorted(new_heads, ranges[:, 0], side="left")
+            new_highs = np.searchsorted(new_heads, ranges[:, 1], side="right")
+            removed = int(np.sum(level_offsets[highs] - level_offsets[lows]))
+            edits = [(low, high, [(new_heads[i], new_tails[new_offsets[i]:new_offsets[i + 1]],
+                                   new_z[new_offsets[i]:new_offsets[i + 1]]) for i in range(new_low, new_high)])
+                     for low, high, new_low, new_high in zip(lows, highs, new_lows, new_highs)]
+            del level_heads, level_offsets
+            level.rewrite_blocks(edits)
+            levels[depth] += len(new_tails) - removed
+
+            if source is not self:
+                source.disconnect()
+            source = level
+        if source is not self:
+            source.disconnect()
+
+        with open(self.path("lod.json"), "w") as f:
+            json.dump(levels, f)
+
+    def rebuild_lod(self, depths, tail_len):
+        for depth in self.read_lod():
+            shutil.rmtree(self.path(f"lod{depth}"), ignore_errors=True)
+
+        levels = {}
+        source = self
+        for depth in sorted(depths):
+            # Every level is thinned from the previous one
+            shift = max(0, 2 * depth - tail_len)  # a cell spans 2^shift heads
+            heads, offsets, tails, z = source.columns()
+            keys_out, z_out = [], []
+            start = 0
+            while start < len(heads):
+                end = min(start + LOD_CHUNK_BLOCKS, len(heads))
+                if end < len(heads):
+                    end = int(np.searchsorted(heads, ((int(heads[end - 1]) >> shift) + 1) << shift, side="left"))
+                start_point, end_point = int(offsets[start]), int(offsets[end])
+                keys = np.repeat(np.asarray(heads[start:end], dtype=np.int64), np.diff(offsets[start:end + 1])) << tail_len
+                keys |= np.asarray(tails[start_point:end_point], dtype=np.int64)
+                first = run_starts(keys >> (2 * depth))
+                keys_out.append(keys[first])
+                z_out.append(np.asarray(z[start_point:end_point])[first])
+                start = end
+            del heads, offsets, tails, z
+
+            keys = np.concatenate(keys_out) if keys_out else np.empty(0, dtype=np.int64)
+            z = np.concatenate(z_out) if z_out else np.empty(0, dtype=np.float64)
+            level = BlockStore(self.db_conf, self.name, lod=depth)
+            level.create_table()
+            level.write_columns(*keys_to_columns(keys, z, tail_len))
+            levels[depth] = len(keys)
+
+            if source is not self:
+                source.disconnect()
+            source = level
+        if source is not self:
+            source.disconnect()
+
+        with open(self.path("lod.json"), "w") as f:
+            json.dump(levels, f)
+
+    def open_lod(self, depth):
+        level = BlockStore(self.db_conf, self.name, lod=depth)
+        level.connect()
+        return level
+
+    def read_lod(self):
+        if not os.path.isfile(self.path("lod.json")):
+            return {}
+        with open(self.path("lod.json"), "r") as f:
+            return {int(depth): point_count for depth, point_count in json.load(f).items()}
+
+    def block(self, i):
+        # Slices of the memory-mapped arrays, no data is copied
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return int(self.heads[i]), self.tails[start:end], self.z[start:end]
+
+    def fetch_ranges(self, ranges, exclude=()):
+        if self.heads is None or len(ranges) == 0:
+            return []
+        ranges = np.asarray(ranges, dtype=np.int64)
+        lows = np.searchsorted(self.heads, ranges[:, 0], side="left")
+        highs = np.searchsorted(self.heads, ranges[:, 1], side="right")
+        blocks = [self.block(i) for low, high in zip(lows, highs) for i in range(low, high)]
+        if len(exclude) > 0:
+            exclude = set(int(head) for head in exclude)
+            blocks = [block for block in blocks if block[0] not in exclude]
+        return blocks
+
+    def fetch_heads(self, heads):
+        if self.heads is None or len(heads) == 0:
+            return []
+        heads = np.asarray(heads, dtype=np.int64)
+        lows = np.searchsorted(self.heads, heads, side="left")
+        highs = np.searchsorted(self.heads, heads, side="right")
+        return [self.block(i) for low, high in zip(lows, highs) for i in range(low, high)]
+
+
+def thin_blocks(blocks, depth, tail_len):
+    """
+    One point per Morton cell of 2^depth x 2^depth units, the one with the smallest key,
+    of blocks in head order with sorted tails, as (heads, offsets, tails, z) columns.
+    """
+    if not blocks:
+        return keys_to_columns(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), tail_len)
+    keys = np.concatenate([(np.int64(head) << tail_len) | np.asarray(tails, dtype=np.int64) for head, tails, _ in blocks])
+    z = np.concatenate([np.asarray(z, dtype=np.float64) for _, _, z in blocks])
+    first = run_starts(keys >> (2 * depth))
+    return keys_to_columns(keys[first], z[first], tail_len)
+
+
+def keys_to_columns(keys, z, tail_len):
+    # Pack sorted keys into blocks: (heads, offsets, tails, z)
+    heads = (keys >> tail_len).astype(np.int32)
+    starts = np.flatnonzero(run_starts(heads))
+    return (heads[starts], np.append(starts, len(keys)).astype(np.int64),
+            (keys & ((1 << tail_len) - 1)).astype(np.int32), z)
+
+
+def run_starts(values):
+    # True at the first element of every run of equal values of a sorted array
+    starts = np.ones(len(values), dtype=bool)
+    starts[1:] = values[1:] != values[:-1]
+    return starts
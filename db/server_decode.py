@@ -0,0 +1,71 @@
+def compact_sql(key, shift):
+    """
+    SQL expression taking every second bit of a BIGINT morton key, starting at bit `shift`.
+    Bit 2i (+ shift) of the key becomes bit i of the result, one term per bit, so that the
+    expression stays a single inlinable SELECT instead of a PL/pgSQL loop.
+    """
+    return " | ".join(f"(({key} >> {i + shift}) & {1 << i})" for i in range(31))
+
+
+DECODE_FUNCTIONS_SQL = f"""
+    CREATE OR REPLACE FUNCTION sfc_decode_x(sfc_key BIGINT) RETURNS BIGINT AS $$
+        SELECT {compact_sql("abs(sfc_key)", 0)}
+    $$ LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE;
+
+    CREATE OR REPLACE FUNCTION sfc_decode_y(sfc_key BIGINT) RETURNS BIGINT AS $$
+        SELECT {compact_sql("abs(sfc_key)", 1)}
+    $$ LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE;
+    """
+
+
+def decode_functions_installed(cursor):
+    cursor.execute("SELECT to_regprocedure('sfc_decode_x(bigint)') IS NOT NULL AND "
+                   "to_regprocedure('sfc_decode_y(bigint)') IS NOT NULL;")
+    return cursor.fetchone()[0]
+
+
+def range_select_sql(source_table, tail_len, scales, offsets):
+    """
+    SELECT decoding, inside PostgreSQL, the points of the blocks in RangeTable
+    (range_start, range_end) and the points of TailRangeTable (sfc_head, range_start,
+    range_end) whose tail is within one of the ranges of their head.
+    """
+    point_sql = f"""ST_MakePoint(sfc_decode_x(sfc_key) * {scales[0]} + {offsets[0]},
+                                 sfc_decode_y(sfc_key) * {scales[1]} + {offsets[1]}, z)"""
+    return f"""
+        SELECT {point_sql} AS point
+        FROM (
+            SELECT (p.sfc_head::BIGINT << {tail_len}) | t.sfc_tail AS sfc_key, t.z
+            FROM {source_table} p
+            JOIN RangeTable r ON p.sfc_head BETWEEN r.range_start AND r.range_end
+            CROSS JOIN LATERAL unnest(p.sfc_tail, p.z) AS t(sfc_tail, z)
+            UNION ALL
+            SELECT (p.sfc_head::BIGINT << {tail_len}) | t.sfc_tail AS sfc_key, t.z
+            FROM {source_table} p
+            JOIN TailRangeTable r ON p.sfc_head = r.sfc_head
+            CROSS JOIN LATERAL unnest(p.sfc_tail, p.z) AS t(sfc_tail, z)
+            WHERE t.sfc_tail BETWEEN r.range_start AND r.range_end
+        ) AS keys
+        """
+
+
+if __name__ == '__main__':
+    # Install the functions in the database of a json parameter file, for datasets
+    # imported before the import did it: python -m db.server_decode --input scripts/query_20m.json
+    import json
+    import argparse
+    from psycopg2 import connect
+
+    parser = argparse.ArgumentParser(description='Install the SQL functions used by query.py --server-decode.')
+    parser.add_argument('--input', type=str, default="./scripts/query_20m.json", help='Input parameter json file path.')
+    parser.add_argument('--password', type=str, default="123456", help='Database password.')
+    args = parser.parse_args()
+
+    with open(args.input, 'r') as f:
+        db_conf = json.load(f)["config"]
+    connection = connect(dbname=db_conf['dbname'], user=db_conf['user'], password=args.password,
+                         host=db_conf['host'], port=db_conf['port'])
+    with connection, connection.cursor() as cursor:
+        cursor.execute(DECODE_FUNCTIONS_SQL)
+    connection.close()
+    print("The functions sfc_decode_x and sfc_decode_y are installed.")
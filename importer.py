@@ -3,12 +3,19 @@ import json
 import time
 import argparse
 from pipeline.import_data import FileLoader, DirLoader
+from pcsfc import instrument
 
 
 def main():
     parser = argparse.ArgumentParser(description='Example of argparse usage.')
     parser.add_argument('--input', type=str, default="./scripts/import.json", help='Input parameter json file path.')
     parser.add_argument('--password', type=str, default="123456", help='Input parameter json file path.')
+    parser.add_argument('--backend', type=str, default="postgres", choices=["postgres", "local"], help='Storage backend.')
+    parser.add_argument('--store', type=str, default="./store", help='Root directory of the local block store.')
+    parser.add_argument('--profile', type=str, default=None, choices=["default", "bulk"], help='PostgreSQL load profile, overrides "profile" in the config.')
+    parser.add_argument('--log', action='store_true', help='Emit spans and counters as structured log lines.')
+    parser.add_argument('--metrics', type=str, default=None, help='Append spans and counters as JSON lines to this file.')
+    parser.add_argument('--cprofile', type=str, default=None, help='Run under cProfile and write the stats to this file.')
     args = parser.parse_args()
     jparams_path = "scripts/import_folder.json"
     jparams_path = args.input
@@ -24,25 +31,44 @@ def main():
 
     db_conf = jparams["config"]
     db_conf["password"] = args.password
+    db_conf["backend"] = args.backend
+    db_conf["store_dir"] = args.store
+    if args.profile:
+        db_conf["profile"] = args.profile
+    instrument.configure(log=args.log, metrics_file=args.metrics)
 
-    for key, value in jparams["imports"].items():
+    with instrument.profiling(args.cprofile):
+        run_imports(jparams["imports"], db_conf)
+
+
+def run_imports(imports, db_conf):
+    for key, value in imports.items():
         print(f"=== Import {key} into PostgreSQL===") # key is name
         start_time = time.time()
+        if value.get("append", False) and db_conf.get("profile") == "bulk":
+            print("The bulk-load profile is only used for fresh loads, appending with the default profile.")
 
-        try:
-            if value["mode"] == "file":
-                pipeline = FileLoader(key, value)
-                pipeline.preparation()
-                print("-> Initial time:", round(time.time() - start_time, 2))
-                pipeline.loading(db_conf)
+        with instrument.context(dataset=key, mode=value["mode"]):
+            try:
+                if value["mode"] == "file":
+                    pipeline = FileLoader(key, value)
+                    if pipeline.append:
+                        pipeline.sync_metadata(db_conf)
+                    pipeline.preparation()
+                    print("-> Initial time:", round(time.time() - start_time, 2))
+                    pipeline.loading(db_conf)
 
-            elif value["mode"] == "dir":
-                pipeline = DirLoader(key, value)
-                pipeline.run(db_conf)
+                elif value["mode"] == "dir":
+                    pipeline = DirLoader(key, value)
+                    if pipeline.append:
+                        pipeline.sync_metadata(db_conf)
+                    pipeline.run(db_conf)
 
-        except Exception as e:
-            print(f"An error occurred: {e}")
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                instrument.error("import", e)
 
+            instrument.flush_counters()
         print("-> Total time: ", round(time.time() - start_time, 2))
 
 
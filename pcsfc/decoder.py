@@ -1,7 +1,7 @@
 import numpy as np
 from numba import jit, int32, int64
 
-@jit(int32(int64))
+@jit(int32(int64), cache=True)
 def Compact2D(m):
     """
     Decodes the 64 bit morton code into a 32 bit number in the 2D space using
@@ -36,7 +36,7 @@ def Compact2D(m):
     return m
 
 
-@jit(int32(int64))
+@jit(int32(int64), cache=True)
 def DecodeMorton2DX(mortonCode):
     """
     Calculates the x coordinate from a 64 bit morton code
@@ -51,7 +51,7 @@ def DecodeMorton2DX(mortonCode):
     return Compact2D(mortonCode)
 
 
-@jit(int32(int64))
+@jit(int32(int64), cache=True)
 def DecodeMorton2DY(mortonCode):
     """
     Calculates the y coordinate from a 64 bit morton code
@@ -64,3 +64,29 @@ def DecodeMorton2DY(mortonCode):
 
     """
     return Compact2D(mortonCode >> 1)
+
+
+def DecodeMorton2DArray(mortonCodes):
+    """
+    Calculates the x and y coordinates of an array of 64 bit morton codes at once,
+    with the same bit operations as Compact2D
+
+    Args:
+        mortonCodes (np.ndarray): the 64 bit morton codes
+
+    Returns:
+        tuple: two np.ndarray of int64, the x and y coordinates
+
+    """
+    m = np.abs(np.asarray(mortonCodes, dtype=np.int64))
+    return _Compact2DArray(m), _Compact2DArray(m >> 1)
+
+
+def _Compact2DArray(m):
+    m = m & 0x5555555555555555
+    m = (m ^ (m >> 1)) & 0x3333333333333333
+    m = (m ^ (m >> 2)) & 0x0f0f0f0f0f0f0f0f
+    m = (m ^ (m >> 4)) & 0x00ff00ff00ff00ff
+    m = (m ^ (m >> 8)) & 0x0000ffff0000ffff
+    m = (m ^ (m >> 16)) & 0x00000000ffffffff
+    return m
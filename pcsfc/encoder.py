@@ -5,7 +5,7 @@ from numba import jit, int32, int64
 ######################      Morton conversion in 2D      ######################
 ###############################################################################
 
-@jit(int64(int32))
+@jit(int64(int32), cache=True)
 def Expand2D(n):
     """
     Encodes the 64 bit morton code for a 31 bit number in the 2D space using
@@ -32,7 +32,7 @@ def Expand2D(n):
     b = (b ^ (b << 1)) & 0x5555555555555555
     return b
 
-@jit(int64(int32, int32))
+@jit(int64(int32, int32), cache=True)
 def EncodeMorton2D(x, y):
     """
     Calculates the 2D morton code from the x, y dimensions
@@ -0,0 +1,235 @@
+import json
+import time
+import atexit
+import logging
+import cProfile
+from functools import wraps
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+logger = logging.getLogger("pcsfc")
+
+# Where the events go: structured log lines on the "pcsfc" logger and/or a JSON lines metrics file.
+# Both are off by default, spans then only cost two perf_counter calls.
+_config = {"log": False, "metrics_file": None}
+_metrics = None  # the metrics file, open from configure until close
+_context = {}  # fields added to every event, see context
+_counters = {}
+_stages = {}  # (name, fields) -> [duration, calls] of the StageTimer stages, see flush_counters
+
+
+def configure(log=False, metrics_file=None):
+    """
+    Enable the output of spans and counters.
+
+    Args:
+        log: emit every event as a JSON log line on the "pcsfc" logger
+        metrics_file: append every event as a JSON line to this file
+    """
+    global _metrics
+
+    close()
+    _config["log"] = log
+    _config["metrics_file"] = metrics_file
+    if metrics_file:
+        _metrics = open(metrics_file, "a")
+    if log and not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+@atexit.register
+def close():
+    global _metrics
+
+    if _metrics is not None:
+        _metrics.close()
+        _metrics = None
+
+
+def enabled():
+    return _config["log"] or _metrics is not None
+
+
+def emit(event):
+    if not enabled():
+        return
+    event = dict(_context, **event, time=round(time.time(), 6))
+    line = json.dumps(event, default=str)
+    if _config["log"]:
+        logger.info(line)
+    if _metrics is not None:
+        _metrics.write(line + "\n")
+
+
+@contextmanager
+def context(**fields):
+    """
+    Add fields, e.g. the name of the query or dataset, to every event emitted inside the
+    block, so that the spans of a metrics file can be tied back to their query.
+    """
+    previous = dict(_context)
+    _context.update(fields)
+    try:
+        yield
+    finally:
+        _context.clear()
+        _context.update(previous)
+
+
+@contextmanager
+def span(name, **fields):
+    """
+    Time a block of code and emit it as {"type": "span", "name": ..., "duration": ...}.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if enabled():
+            emit(dict(fields, type="span", name=name, duration=round(time.perf_counter() - start_time, 6)))
+
+
+def traced(name=None):
+    """
+    Decorator version of span, named after the function by default.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    _counters[name] = _counters.get(name, 0) + n
+
+
+def add_stage(name, duration, fields):
+    key = (name, tuple(sorted(fields.items())))
+    total = _stages.setdefault(key, [0.0, 0])
+    total[0] += duration
+    total[1] += 1
+
+
+def flush_counters(**fields):
+    """
+    Emit the stages and counters accumulated since the last flush and reset them: one span
+    per stage, with its total duration and number of calls, then the counters (points,
+    blocks, ranges, bytes, ...).
+    """
+    for (name, stage_fields), (duration, calls) in _stages.items():
+        emit(dict(fields, **dict(stage_fields), type="span", name=name, duration=round(duration, 6), calls=calls))
+    emit(dict(fields, type="counters", counters=dict(_counters), peak_rss_kb=peak_rss_kb()))
+    _stages.clear()
+    _counters.clear()
+
+
+def error(name, exception, **fields):
+    emit(dict(fields, type="error", name=name, error=repr(exception)))
+
+
+@contextmanager
+def profiling(path=None):
+    """
+    Run the block under cProfile and dump the stats to path, for snakeviz or pstats.
+    Without a path nothing is profiled; sampling profilers such as py-spy need no hook
+    and see the same function names as the spans.
+    """
+    if path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Profile is written to {path}.")
+
+
+class StageTimer:
+    def __init__(self):
+        """
+        Accumulates the wall-clock time of named stages (e.g. "plan", "fetch", "decode")
+        and counters (e.g. "blocks", "rows") of one import or query. Stages run once per
+        block or head, so they are not emitted one by one: their time is added to the
+        global stages and every counter to the global counters, emitted by flush_counters.
+        """
+        self.timings = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name, **fields):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            self.timings[name] = self.timings.get(name, 0.0) + duration
+            add_stage(name, duration, fields)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+        count(name, n)
+
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+
+
+def peak_rss_kb():
+    """
+    Peak resident set size of the process so far in KB, None where it is not available.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def proc_status_kb(field):
+    # A memory field of /proc/self/status in KB, e.g. VmRSS or VmHWM; None where there is no /proc
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+@contextmanager
+def memory_window():
+    """
+    Memory used by a block of code, as {"peak_rss_kb": ..., "rss_delta_kb": ...}, filled in
+    when the block exits. The peak RSS of the process is reset to its current RSS first
+    (Linux, /proc/self/clear_refs), so the peak is the one of this block only, not of an
+    earlier import or query in the same process; rss_delta_kb is that peak minus the RSS
+    at the start. Both stay None where the peak cannot be reset.
+    """
+    usage = {"peak_rss_kb": None, "rss_delta_kb": None}
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        start_rss = proc_status_kb("VmRSS")
+    except OSError:
+        start_rss = None
+
+    try:
+        yield usage
+    finally:
+        peak = proc_status_kb("VmHWM") if start_rss is not None else None
+        if peak is not None:
+            usage["peak_rss_kb"] = peak
+            usage["rss_delta_kb"] = peak - start_rss
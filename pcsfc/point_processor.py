@@ -5,6 +5,7 @@ from itertools import groupby
 from collections import Counter
 
 from pcsfc.encoder import EncodeMorton2D
+from pcsfc.instrument import traced, count
 
 
 def compute_split_length(x, y, ratio):
@@ -35,7 +36,9 @@ class PointProcessor:
         self.write_csv(pt_blocks)
 
 
+    @traced()
     def encode_split_points(self, points):
+        count("points", len(points))
         encoded_points = []
         for pt in points:
             # Encode XY coordinates to Morton key
@@ -50,6 +53,7 @@ class PointProcessor:
 
         return encoded_points
 
+    @traced()
     def make_groups(self, my_data):
         # Group the list by the first element of each sublist
         sorted_list = sorted(my_data, key=lambda x: x[0])  # Sort by SFC head
@@ -65,12 +69,14 @@ class PointProcessor:
             z = [sorted_group[i][2] for i in range(n)]
             histogram.append((key, n))
             pt_blocks.append((key, sfc_tail, z))
+        count("blocks", len(pt_blocks))
 
         df_hist = pd.DataFrame(histogram, columns=['head', 'num_tail'])
         df_hist.to_csv("histogram.csv")
 
         return pt_blocks
 
+    @traced()
     def write_csv(self, pt_blocks, filename="pc_record.csv"):
         df = pd.DataFrame(pt_blocks, columns=['sfc_head', 'sfc_tail', 'z'])
         df['sfc_tail'] = df['sfc_tail'].apply(lambda x: str(x).replace('[', '{').replace(']', '}'))
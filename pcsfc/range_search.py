@@ -1,4 +1,5 @@
 from pcsfc.decoder import DecodeMorton2DX, DecodeMorton2DY
+from pcsfc.instrument import traced, count
 
 
 def morton_range(bbox, start, body_len, end_len):
@@ -43,5 +44,12 @@ def morton_range(bbox, start, body_len, end_len):
             break
 
     overlaps_shift = [(key >> end_len) - (start << body_len)for key in overlaps]
+    count("ranges", len(ranges) + len(overlaps_shift))
     #overlaps_shift =
     return ranges, overlaps_shift
+
+
+@traced("morton_range")
+def morton_head_range(bbox, head_len, tail_len):
+    # The head-level search of a query, traced once; the per-head tail searches are not
+    return morton_range(bbox, 0, head_len, tail_len)
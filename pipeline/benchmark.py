@@ -0,0 +1,163 @@
+import csv
+import json
+import time
+import statistics
+
+from pcsfc.instrument import memory_window, context, flush_counters
+from pipeline.import_data import FileLoader, DirLoader
+from pipeline.retrieve_data import Querier, LocalQuerier
+from db import get_backend
+
+
+STAGES = ["prepare", "load", "index", "lod", "plan", "fetch", "decode", "refine", "materialize", "export"]
+COUNTERS = ["blocks", "rows", "result_rows"]
+MEMORY = ["peak_rss_kb", "rss_delta_kb"]
+
+
+class BenchmarkRunner:
+    def __init__(self, db_conf, warmup=1, repeat=3, export=False):
+        """
+        Run import and query suites several times and record the per-stage timings
+        and the peak memory of every run.
+        The first `warmup` runs of every entry are recorded but left out of the summary.
+        """
+        self.db_conf = db_conf
+        self.warmup = warmup
+        self.repeat = repeat
+        self.export = export
+        self.runs = []
+
+    def run_imports(self, imports):
+        for name, parameters in imports.items():
+            for run in range(self.warmup + self.repeat):
+                print(f"=== Benchmark import {name}, run {run} ===")
+                db = get_backend(self.db_conf, name)
+                db.connect()
+                db.drop_tables()
+                db.disconnect()
+
+                start_time = time.perf_counter()
+                error = None
+                with memory_window() as memory, context(suite="import", entry=name, run=run):
+                    try:
+                        if parameters["mode"] == "file":
+                            loader = FileLoader(name, parameters)
+                            loader.preparation()
+                            loader.loading(self.db_conf)
+                        else:
+                            loader = DirLoader(name, parameters)
+                            loader.run(self.db_conf)
+                        timer, point_count = loader.timer, loader.meta[2]
+                    except Exception as e:
+                        print(f"An error occurred: {e}")
+                        timer, point_count, error = None, None, str(e)
+                    flush_counters()
+
+                self.record("import", name, run, time.perf_counter() - start_time, timer,
+                            dict(memory, rows=point_count), error)
+
+    def run_queries(self, queries):
+        for name, value in queries.items():
+            for run in range(self.warmup + self.repeat):
+                print(f"=== Benchmark {value['mode']} query {name}, run {run} ===")
+                start_time = time.perf_counter()
+                timer, result_rows, error = None, None, None
+                with memory_window() as memory, context(suite="query", entry=name, run=run):
+                    try:
+                        if self.db_conf.get("backend") == "local":
+                            querier = LocalQuerier(name, value["source_dataset"], self.db_conf)
+                        else:
+                            querier = Querier(name, value["source_dataset"], self.db_conf)
+                        querier.drop_result_table()
+                        timer = querier.timer
+                        querier.select_lod(value["mode"], value["geometry"], value.get("lod"), value.get("max_points"))
+
+                        querier.geometry_query(value["mode"], value["geometry"])
+                        if "maxz" in value:
+                            querier.maxz_query(value["maxz"])
+                        if "minz" in value:
+                            querier.minz_query(value["minz"])
+                        result_rows = querier.result_count()
+
+                        with timer.stage("export"):
+                            querier.disconnect()
+                            if self.export and self.db_conf.get("backend") != "local":
+                                from exporter import Pg2Las
+                                Pg2Las(self.db_conf, name)
+                    except Exception as e:
+                        print(f"An error occurred: {e}")
+                        error = str(e)
+                    flush_counters()
+
+                self.record("query", name, run, time.perf_counter() - start_time, timer,
+                            dict(memory, result_rows=result_rows), error)
+
+    def record(self, suite, name, run, total, timer, counters, error=None):
+        entry = {"suite": suite, "name": name, "run": run, "warmup": run < self.warmup,
+                 "total": round(total, 4), "peak_rss_kb": None, "rss_delta_kb": None, "error": error}
+        for stage in STAGES:
+            entry[stage] = round(timer.timings[stage], 4) if timer and stage in timer.timings else None
+        for counter in COUNTERS:
+            entry[counter] = timer.counters.get(counter) if timer else None
+        entry.update({key: value for key, value in counters.items() if value is not None})
+        self.runs.append(entry)
+        print("-> Total time:", round(total, 2))
+
+    def summary(self):
+        """
+        Median of every stage over the measured (non warm-up) runs, keyed by "suite/name".
+        """
+        groups = {}
+        for entry in self.runs:
+            if not entry["warmup"] and entry["error"] is None:
+                groups.setdefault(f"{entry['suite']}/{entry['name']}", []).append(entry)
+
+        summary = {}
+        for key, entries in groups.items():
+            summary[key] = {"runs": len(entries), "min_total": min(e["total"] for e in entries)}
+            for field in ["total"] + STAGES:
+                values = [e[field] for e in entries if e[field] is not None]
+                summary[key][field] = round(statistics.median(values), 4) if values else None
+            for field in COUNTERS:
+                summary[key][field] = entries[-1][field]
+            # Memory of the runs themselves, see instrument.memory_window
+            for field in MEMORY:
+                values = [e[field] for e in entries if e[field] is not None]
+                summary[key][field] = max(values) if values else None
+        return summary
+
+    def write_results(self, prefix):
+        with open(prefix + ".json", "w") as f:
+            json.dump({"db_conf": {k: v for k, v in self.db_conf.items() if k != "password"},
+                       "warmup": self.warmup, "repeat": self.repeat,
+                       "runs": self.runs, "summary": self.summary()}, f, indent=2)
+
+        fields = ["suite", "name", "run", "warmup", "total"] + STAGES + COUNTERS + MEMORY + ["error"]
+        with open(prefix + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for entry in self.runs:
+                writer.writerow({field: entry.get(field) for field in fields})
+        print(f"Benchmark results are written to {prefix}.json and {prefix}.csv.")
+
+
+def compare(summary, baseline_path, threshold=0.1):
+    """
+    Compare the median total time of every entry with a previous results file.
+
+    Returns:
+        list: (key, baseline median, current median, ratio) of the entries that are more
+        than `threshold` slower than in the baseline
+    """
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)["summary"]
+
+    regressions = []
+    for key, current in summary.items():
+        if key not in baseline or not baseline[key]["total"]:
+            continue
+        ratio = current["total"] / baseline[key]["total"]
+        print(f"{key}: {baseline[key]['total']}s -> {current['total']}s ({ratio:.2f}x)")
+        if ratio > 1 + threshold:
+            regressions.append((key, baseline[key]["total"], current["total"], ratio))
+    return regressions
@@ -5,7 +5,42 @@ import pandas as pd
 import laspy
 
 from pcsfc.point_processor import compute_split_length, PointProcessor
-from db import Postgres
+from pcsfc.instrument import StageTimer
+from db import get_backend
+
+# The level-of-detail pyramid is opt-in: "lod": [2, 4, 6, 8] in the import parameters
+# builds levels of one point per 4 x 4, 16 x 16, 64 x 64 and 256 x 256 units.
+LOD_DEPTHS = []
+
+
+def sync_split_length(meta, db_conf):
+    """
+    When appending, the new points must be split with the tail length of the stored
+    dataset. The head length only grows when the new points need longer keys.
+    """
+    db = get_backend(db_conf, meta[0])
+    db.connect()
+    stored = db.read_metadata()
+    db.disconnect()
+    if stored is None:
+        raise ValueError(f"There is no dataset {meta[0]} to append to.")
+
+    key_len = meta[3] + meta[4]
+    meta[4] = stored["tail_length"]
+    meta[3] = max(key_len - meta[4], stored["head_length"])
+    return meta
+
+
+def update_lod(db, lod, append, timer):
+    """
+    Build the pyramid after a fresh load. After an append, only the cells of the merged
+    heads are thinned again, in the levels given or, without "lod", in the existing ones.
+    """
+    depths = lod or (sorted(db.read_lod()) if append else [])
+    if not depths:
+        return
+    with timer.stage("lod"):
+        db.build_lod(depths, heads=db.merged_heads if append else None)
 
 
 class FileLoader:
@@ -13,6 +48,9 @@ class FileLoader:
         self.name = name
         self.path = parameters["path"]
         self.tail_len = None
+        self.append = parameters.get("append", False)
+        self.lod = parameters.get("lod", LOD_DEPTHS)
+        self.timer = StageTimer()
 
         self.meta = self.get_metadata(parameters["srid"], parameters["ratio"])
         print(self.meta)
@@ -29,23 +67,37 @@ class FileLoader:
         meta = [self.name, srid, point_count, head_len, self.tail_len, scales, offsets, bbox]
         return meta
 
+    def sync_metadata(self, db_conf):
+        self.meta = sync_split_length(self.meta, db_conf)
+        self.tail_len = self.meta[4]
+
     def preparation(self):
-        processor = PointProcessor(self.path, self.tail_len)
-        processor.execute()
+        with self.timer.stage("prepare"):
+            processor = PointProcessor(self.path, self.tail_len)
+            processor.execute()
 
     def loading(self, db_conf):
         start_time = time.time()
-        db = Postgres(db_conf, self.name)
+        db = get_backend(db_conf, self.name, self.append)
         db.connect()
 
-        db.create_table()
-        db.insert_metadata(self.meta)
-        db.copy_points()
+        with self.timer.stage("load"):
+            if self.append:
+                # Only the blocks with new points are rewritten, the index is kept
+                db.stage_points()
+                db.merge_staging()
+                db.update_metadata(self.meta)
+            else:
+                db.create_table()
+                db.insert_metadata(self.meta)
+                db.copy_points()
 
         load_time = time.time()
         print("-> Loading time:", round(load_time - start_time, 2))
 
-        db.create_btree_index()
+        with self.timer.stage("index"):
+            db.create_btree_index()
+        update_lod(db, self.lod, self.append, self.timer)
         db.disconnect()
         print("-> Close time:", round(time.time() - load_time, 2))
 
@@ -55,6 +107,9 @@ class DirLoader:
         self.name = name
         self.paths = self.get_file_paths(parameters["path"])
         self.tail_len = None
+        self.append = parameters.get("append", False)
+        self.lod = parameters.get("lod", LOD_DEPTHS)
+        self.timer = StageTimer()
 
         self.meta = self.get_metadata(parameters["srid"], parameters["ratio"])
         print("The number of files: ", len(self.paths))
@@ -85,12 +140,17 @@ class DirLoader:
         meta = [self.name, srid, point_count, head_len, tail_len, scales, offsets, bbox]
         return meta
 
-    def run(self, db_conf):
-        db = Postgres(db_conf, self.name)
-        db.connect()
+    def sync_metadata(self, db_conf):
+        self.meta = sync_split_length(self.meta, db_conf)
+        self.tail_len = self.meta[4]
 
-        db.create_table()
-        db.insert_metadata(self.meta)
+    def run(self, db_conf):
+        if not self.append:
+            db = get_backend(db_conf, self.name, self.append)
+            db.connect()
+            db.create_table()
+            db.insert_metadata(self.meta)
+            db.disconnect()
 
         load_time_count = 0
         for i in range(len(self.paths)):
@@ -98,22 +158,29 @@ class DirLoader:
                 print(i, " is being processed.")
 
             # Preparation: Encode, split and group the Morton keys
-            processor = PointProcessor(self.paths[i], self.meta[4])# tail_len
-            processor.execute()
+            with self.timer.stage("prepare"):
+                processor = PointProcessor(self.paths[i], self.meta[4])# tail_len
+                processor.execute()
 
             # Import the data into the database
             load_time_1 = time.time()
-            db = Postgres(db_conf, self.name)
+            db = get_backend(db_conf, self.name, self.append)
             db.connect()
-            if i == 0:
-                db.create_table()
-                db.insert_metadata(self.meta)
-
-            db.copy_points()
+            with self.timer.stage("load"):
+                if self.append:
+                    db.stage_points()
+                else:
+                    db.copy_points()
 
             if i == (len(self.paths)-1):
+                with self.timer.stage("load"):
+                    if self.append:
+                        db.merge_staging()
+                        db.update_metadata(self.meta)
                 close_time_1 = time.time()
-                db.create_btree_index()
+                with self.timer.stage("index"):
+                    db.create_btree_index()
+                update_lod(db, self.lod, self.append, self.timer)
                 db.disconnect()
                 close_time_count = time.time() - close_time_1
 
@@ -0,0 +1,142 @@
+import json
+import time
+import numpy as np
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from pcsfc.decoder import DecodeMorton2DArray
+from pcsfc.range_search import morton_range
+from pcsfc import instrument
+from db.backend import check_table_name, check_dataset_name
+from pipeline.retrieve_data import Querier, LocalQuerier
+
+MODES = ["bbox", "circle", "polygon", "nn", "multi"]
+
+
+class QueryServer:
+    def __init__(self, db_conf):
+        """
+        Long-lived query process: the numba functions, shapely and the database connection
+        (or the memory-mapped block stores) are loaded once and reused by every request.
+        A request is a query suite in the format of scripts/query_*.json, {"queries": {...}},
+        or a single query {"name": ..., "source_dataset": ..., "mode": ..., "geometry": ...}.
+        Requests come from the network: the query and dataset names are checked before
+        they are used as table or file names, and the other values are passed as query
+        parameters or numbers.
+        """
+        self.db_conf = db_conf
+        self.local = db_conf.get("backend") == "local"
+        self.connection = None
+        self.stores = {}
+
+    def warm_up(self):
+        start_time = time.time()
+        morton_range([0, 1, 0, 1], 0, 4, 4)
+        DecodeMorton2DArray(np.zeros(1, dtype=np.int64))
+        import shapely.wkt
+
+        if not self.local:
+            from psycopg2 import connect
+            self.connection = connect(
+                dbname=self.db_conf['dbname'],
+                user=self.db_conf['user'],
+                password=self.db_conf['password'],
+                host=self.db_conf['host'],
+                port=self.db_conf['port']
+            )
+        print("-> Warm-up time:", round(time.time() - start_time, 2))
+
+    def querier(self, name, source_name):
+        if not self.local:
+            return Querier(name, source_name, self.db_conf, connection=self.connection)
+
+        if source_name not in self.stores:
+            from db.block_store import BlockStore
+            store = BlockStore(self.db_conf, source_name)
+            store.connect()
+            self.stores[source_name] = store
+        return LocalQuerier(name, source_name, self.db_conf, store=self.stores[source_name])
+
+    def run(self, name, value):
+        start_time = time.time()
+        with instrument.context(query=name, mode=value.get("mode"), source=value.get("source_dataset")):
+            try:
+                querier = self.querier(name, value["source_dataset"])
+                # The result table of a previous request with the same name is replaced
+                querier.drop_result_table()
+                querier.select_lod(value["mode"], value["geometry"], value.get("lod"), value.get("max_points"))
+                querier.geometry_query(value["mode"], value["geometry"])
+                if "maxz" in value:
+                    querier.maxz_query(value["maxz"])
+                if "minz" in value:
+                    querier.minz_query(value["minz"])
+                result_rows = querier.result_count()
+                querier.disconnect()
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                instrument.error("query", e)
+                if self.connection:
+                    self.connection.rollback()
+                return {"name": name, "error": str(e)}
+            finally:
+                instrument.flush_counters()
+
+        return {"name": name, "result_rows": result_rows, "timings": querier.timer.timings,
+                "counters": querier.timer.counters, "total": round(time.time() - start_time, 4)}
+
+    def handle(self, request):
+        """
+        Raises:
+            ValueError, KeyError, TypeError: for an invalid request, before any query runs
+        """
+        if not isinstance(request, dict):
+            raise TypeError("The request must be a JSON object.")
+        queries = request["queries"] if "queries" in request else {request["name"]: request}
+        if not isinstance(queries, dict):
+            raise TypeError("queries must be a JSON object.")
+        for name, value in queries.items():
+            self.validate(name, value)
+        return [self.run(name, value) for name, value in queries.items()]
+
+    @staticmethod
+    def validate(name, value):
+        check_table_name(name)
+        check_dataset_name(value["source_dataset"])
+        if value["mode"] not in MODES:
+            raise ValueError(f"Invalid mode: {value['mode']!r}, use one of {MODES}.")
+        for key in ["maxz", "minz", "lod", "max_points"]:
+            if key in value and not isinstance(value[key], (int, float)):
+                raise ValueError(f"{key} must be a number.")
+
+    def serve(self, host="localhost", port=8765):
+        self.warm_up()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    status, body = 200, server.handle(request)
+                except (json.JSONDecodeError, KeyError, ValueError, TypeError) as e:
+                    status, body = 400, {"error": f"Invalid request: {e}"}
+
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        if host not in ("localhost", "127.0.0.1", "::1"):
+            print(f"WARNING: the query server has no authentication and is reachable on {host}.")
+        httpd = HTTPServer((host, port), Handler)
+        print(f"Query server is listening on http://{host}:{port}")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            if self.connection:
+                self.connection.close()
+            for store in self.stores.values():
+                store.disconnect()
@@ -1,38 +1,116 @@
 import numpy as np
-import pandas as pd
-import laspy
 import time
+import math
+import heapq
 
-from shapely.wkt import loads
-from psycopg2 import connect, Error, extras
+from pcsfc.decoder import DecodeMorton2DArray
+from pcsfc.range_search import morton_range, morton_head_range
+from pcsfc.instrument import StageTimer
 
-from pcsfc.decoder import DecodeMorton2DX, DecodeMorton2DY
-from pcsfc.range_search import morton_range
+# shapely, psycopg2 and the block store are imported where they are used, so that a
+# query only pays for the libraries of its own backend and geometry type.
 
 
 class Querier:
-    def __init__(self, query_name, source_name, db_conf):
+    def __init__(self, query_name, source_name, db_conf, connection=None):
+        """
+        The blocks are read through the storage backend of the source dataset (see
+        db.backend.Backend); the result is written to the table {query_name}.
+
+        Args:
+            connection: an open psycopg2 connection to reuse, e.g. from a long-lived query
+                server. It is left open by disconnect().
+        """
         self.head_len = 28
         self.tail_len = 24
         self.scales = [1, 1, 1]
         self.offsets = [0, 0, 0]
+        self.point_count = None
+        self.bbox = None
+
+        from db.backend import check_table_name
+
+        self.source_name = source_name
+        self.name = check_table_name(query_name)
+        self.timer = StageTimer()
+        self.server_decode = db_conf.get("server_decode", False)
+
+        # self.db holds the metadata and the connection, self.source is where the blocks
+        # are read from: the dataset itself or one of its levels of detail
+        self.owns_connection = connection is None
+        self.db = self.open_backend(db_conf, source_name, connection)
+        self.source = self.db
+        self.connection = getattr(self.db, "connection", None)
+        self.cursor = getattr(self.db, "cursor", None)
+        if self.connection is None:
+            return
+
+        self.read_metadata()
+        if self.server_decode:
+            # The functions are installed by the import, or by python -m db.server_decode
+            from db.server_decode import decode_functions_installed
+            if not decode_functions_installed(self.cursor):
+                print("The sfc_decode_x/y functions are not installed, run python -m db.server_decode. "
+                      "The points are decoded on the client.")
+                self.server_decode = False
+
+    def open_backend(self, db_conf, source_name, connection=None):
+        from db import Postgres
+
+        db = Postgres(db_conf, source_name)
+        db.connect(connection)
+        return db
 
-        self.source_table = "point_1m_" + source_name
-        self.name = query_name
+    def read_metadata(self):
+        # Use the split of the source dataset, keep the defaults for datasets without metadata
+        meta = self.db.read_metadata()
+        if meta:
+            self.head_len, self.tail_len = meta["head_length"], meta["tail_length"]
+            self.scales, self.offsets = meta["scales"], meta["offsets"]
+            self.point_count, self.bbox = meta["point_count"], meta["bbox"]
 
-        try:
-            self.connection = connect(
-                dbname=db_conf['dbname'],
-                user=db_conf['user'],
-                password=db_conf['password'],
-                host=db_conf['host'],
-                port=db_conf['port']
-            )
-            self.cursor = self.connection.cursor()
-        except Error as e:
-            print("Error: Unable to connect to the database.")
-            print(e)
+    def use_lod(self, depth):
+        if self.source is not self.db:
+            self.source.disconnect()
+        self.source = self.db.open_lod(depth)
+
+    def select_lod(self, mode, geometry, lod=None, max_points=None):
+        """
+        Answer the query from a level of the LOD pyramid instead of the full points: the
+        level of depth `lod`, or the most detailed level expected to return at most
+        `max_points` points within the geometry. Without both, the full points are used.
+
+        Returns:
+            int: the depth of the level, 0 for the full points
+        """
+        if lod is None and max_points is None:
+            return 0
+        lod = None if lod is None else int(lod)
+        max_points = None if max_points is None else int(max_points)
+
+        with self.timer.stage("plan"):
+            levels = self.db.read_lod()
+            if lod is None:
+                if not levels:
+                    print(f"No levels of detail for {self.source_name}, the full points are used.")
+                    return 0
+                lod = choose_lod(levels, self.point_count, self.bbox, geometry_bbox(mode, geometry),
+                                 max_points, self.scales[0])
+            elif lod and lod not in levels:
+                raise ValueError(f"No level of detail {lod} for {self.source_name}, the levels are {sorted(levels)}.")
+
+        if lod:
+            self.use_lod(lod)
+        print(f"The query is answered from level of detail {lod}.")
+        return lod
+
+    def drop_result_table(self):
+        self.cursor.execute(f"DROP TABLE IF EXISTS {self.name};")
+        self.connection.commit()
 
+    def result_count(self):
+        self.cursor.execute(f"SELECT count(*) FROM {self.name};")
+        return self.cursor.fetchone()[0]
 
     def geometry_query(self, mode, geometry):
         if mode == "bbox":
@@ -42,7 +120,9 @@ class Querier:
         elif mode == "polygon":
             self.polygon_query(geometry)
         elif mode == "nn":
-            print("nn search is not developed yet.")
+            self.nn_query(geometry)
+        elif mode == "multi":
+            self.multi_query(geometry)
 
     def bbox_query(self, bbox):
         start_time = time.time()
@@ -62,126 +142,554 @@ class Querier:
         filter_time = time.time()
         print("-> Filter step time:", round(filter_time - start_time, 2))
 
-        # 3. Use PostGIS function to query the points inside the circle, create table as result
-        circle_query = f"""
-            DELETE FROM {self.name}
-            WHERE NOT ST_DWithin(point, ST_MakePoint({center_x}, {center_y}), {radius});
-        """
-        self.cursor.execute(circle_query)
-        self.connection.commit()
+        # 3. Keep the points inside the circle
+        with self.timer.stage("refine", kind="circle"):
+            self.refine_circle(center_x, center_y, radius)
         print(f"Circle search is updated in {self.name}.")
         print("-> Refinement (circle) step time:", round(time.time() - filter_time, 2))
 
-
     def polygon_query(self, wkt_string):
         start_time = time.time()
         # 1. Compute bounding box
+        from shapely.wkt import loads
+
         polygon = loads(wkt_string)
-        exterior_coords = list(polygon.exterior.coords)
-        x = [pt[0] for pt in exterior_coords]
-        y = [pt[1] for pt in exterior_coords]
-        bbox = [min(x), max(x), min(y), max(y)]
+        x_min, y_min, x_max, y_max = polygon.bounds
+        bbox = [x_min, x_max, y_min, y_max]
 
         # 2. Range search based on bounding box and create table as intermediate result
         self.range_search(bbox)
         filter_time = time.time()
         print("-> Filter step time:", round(filter_time - start_time, 2))
 
-        # 3. Use PostGIS function to query the points inside the circle, create table as result
-        polygon_query = f"""
-            DELETE FROM {self.name}
-            WHERE NOT ST_Within(point, ST_GeomFromText('{wkt_string}'))
-        """
-        self.cursor.execute(polygon_query)
-        self.connection.commit()
+        # 3. Keep the points inside the polygon
+        with self.timer.stage("refine", kind="polygon"):
+            self.refine_polygon(polygon, wkt_string)
         print(f"Polygon search is updated in {self.name}.")
         print("-> Refinement (polygon) step time:", round(time.time() - filter_time, 2))
 
     def maxz_query(self, maxz):
         start_time = time.time()
-        z_query = f"""
-            DELETE FROM {self.name}
-            WHERE ST_Z(point) > {maxz}
-        """
-        self.cursor.execute(z_query)
-        self.connection.commit()
+        with self.timer.stage("refine", kind="max_z"):
+            self.refine_z(maxz=maxz)
         print(f"Max height search is updated in {self.name}.")
         print("-> Refinement (max_z) step time:", round(time.time() - start_time, 2))
 
     def minz_query(self, minz):
         start_time = time.time()
-        z_query = f"""
+        with self.timer.stage("refine", kind="min_z"):
+            self.refine_z(minz=minz)
+        print(f"Min height search is updated in {self.name} successfully.")
+        print("-> Refinement (min_z) step time:", round(time.time() - start_time, 2))
+
+    def refine_circle(self, center_x, center_y, radius):
+        # Use PostGIS function to query the points inside the circle
+        self.cursor.execute(f"""
+            DELETE FROM {self.name}
+            WHERE NOT ST_DWithin(point, ST_MakePoint(%s, %s), %s);
+        """, (float(center_x), float(center_y), float(radius)))
+        self.connection.commit()
+
+    def refine_polygon(self, polygon, wkt_string):
+        self.cursor.execute(f"""
             DELETE FROM {self.name}
-            WHERE ST_Z(point) < {minz}
+            WHERE NOT ST_Within(point, ST_GeomFromText(%s))
+        """, (wkt_string,))
+        self.connection.commit()
+
+    def refine_z(self, maxz=None, minz=None):
+        if maxz is not None:
+            self.cursor.execute(f"DELETE FROM {self.name} WHERE ST_Z(point) > %s", (float(maxz),))
+        if minz is not None:
+            self.cursor.execute(f"DELETE FROM {self.name} WHERE ST_Z(point) < %s", (float(minz),))
+        self.connection.commit()
+
+    def multi_query(self, geometries):
         """
-        self.cursor.execute(z_query)
+        Run many bbox/circle/polygon queries at once, geometries = [[mode, geometry], ...].
+        The head ranges of all the geometries are merged, so a block needed by several
+        geometries is fetched and decoded only once. The points are then assigned to
+        each geometry with vectorized tests, and the result table gets a query_id column
+        holding the index of the geometry in the list.
+        """
+        start_time = time.time()
+        shapes = [make_shape(mode, geometry) for mode, geometry in geometries]
+
+        # 1. Find the heads of every geometry and merge them
+        heads_per_shape = []
+        with self.timer.stage("plan"):
+            for shape in shapes:
+                head_ranges, head_overlaps = morton_head_range(self.transform_bbox(shape[1]), self.head_len, self.tail_len)
+                heads_per_shape.append((head_ranges, head_overlaps))
+        all_ranges = merge_ranges([rg for head_ranges, _ in heads_per_shape for rg in head_ranges])
+        all_overlaps = np.unique(np.array([head for _, head_overlaps in heads_per_shape for head in head_overlaps],
+                                          dtype=np.int64))
+        all_overlaps = all_overlaps[~in_ranges(all_overlaps, all_ranges)]
+
+        # 2. Fetch and decode each block once
+        blocks = self.fetch_ranges(all_ranges) + self.fetch_heads(all_overlaps)
+        if blocks:
+            points = np.vstack([self.decode_block(sfc_head, sfc_tail, z) for (sfc_head, sfc_tail, z) in blocks])
+        else:
+            points = np.empty((0, 3))
+        block_index = BlockIndex(blocks)
+        filter_time = time.time()
+        print("-> Filter step time:", round(filter_time - start_time, 2))
+
+        # 3. Assign the points to the geometries, only testing the points of the blocks of each geometry
+        query_ids, results = [], []
+        with self.timer.stage("refine", kind="multi"):
+            for i, (shape, (head_ranges, head_overlaps)) in enumerate(zip(shapes, heads_per_shape)):
+                candidates = block_index.points(head_ranges, head_overlaps)
+                inside = candidates[shape_contains(shape, points[candidates, 0], points[candidates, 1])]
+                query_ids.append(np.full(len(inside), i))
+                results.append(points[inside])
+        query_ids = np.concatenate(query_ids) if query_ids else np.empty(0, dtype=np.int64)
+        results = np.vstack(results) if results else np.empty((0, 3))
+        print("-> Refinement (multi) step time:", round(time.time() - filter_time, 2))
+
+        with self.timer.stage("materialize"):
+            self.save_multi_results(query_ids, results)
+
+    def save_multi_results(self, query_ids, points):
+        from psycopg2 import extras
+
+        self.cursor.execute(f"CREATE TABLE {self.name} (query_id INT, point geometry(PointZ));")
+        extras.execute_values(self.cursor, f"INSERT INTO {self.name} VALUES %s",
+                              [(int(i), float(x), float(y), float(z)) for i, (x, y, z) in zip(query_ids, points)],
+                              template="(%s, ST_MakePoint(%s, %s, %s))", page_size=10000)
         self.connection.commit()
-        print(f"Min height search is updated in {self.name} successfully.")
-        print("-> Refinement (min_z) step time:", round(time.time() - start_time, 2))
+        print(f"Points of {len(set(query_ids.tolist()))} geometries are inserted into the table {self.name}.")
 
-    def range_search(self, bbox):
-        # 0. Scale and shift the bounding box ,
+    def nn_query(self, geometry):
+        """
+        k nearest neighbours of one point, geometry = [[x, y], k], or of a batch of
+        points, geometry = [[[x1, y1], [x2, y2], ...], k]. The decoded blocks are
+        shared by all the points of a batch, so every block is fetched at most once.
+        """
+        start_time = time.time()
+        query_points, k = geometry[0], geometry[1]
+        if not isinstance(query_points[0], (list, tuple)):
+            query_points = [query_points]
+
+        blocks = {}  # sfc_head -> decoded points of the block
+        results = []
+        for i, (qx, qy) in enumerate(query_points):
+            for rank, (dist, point) in enumerate(self.knn(qx, qy, k, blocks)):
+                results.append([i, rank, dist, point[0], point[1], point[2]])
+        print("-> Filter step time:", round(time.time() - start_time, 2))
+
+        with self.timer.stage("materialize"):
+            self.save_nn_results(results)
+
+    def knn(self, qx, qy, k, blocks):
+        """
+        Start from the head containing (qx, qy) and expand the search box ring by ring.
+        The k closest points seen so far are kept in a bounded max-heap. The search
+        stops when the k-th distance is within the search radius, because every
+        block intersecting the search box has been visited by then.
+        """
+        heap = []  # (-squared distance, x, y, z), at most k items
+        visited = set()
+        max_radius = 1 << ((self.head_len + self.tail_len) // 2)
+        radius = 0
+
+        while True:
+            bbox = self.transform_bbox([qx - radius, qx + radius, qy - radius, qy + radius])
+            with self.timer.stage("plan"):
+                head_ranges, head_overlaps = morton_head_range(bbox, self.head_len, self.tail_len)
+
+            # Fetch the blocks that no previous ring or query point has fetched yet
+            cached = list(blocks.keys())
+            for (sfc_head, sfc_tail, z) in self.fetch_ranges(head_ranges, exclude=cached):
+                self.cache_block(blocks, sfc_head, sfc_tail, z)
+            missing = [head for head in head_overlaps if head not in blocks]
+            for (sfc_head, sfc_tail, z) in self.fetch_heads(missing):
+                self.cache_block(blocks, sfc_head, sfc_tail, z)
+
+            with self.timer.stage("refine", kind="nn"):
+                heads = np.fromiter(blocks.keys(), dtype=np.int64, count=len(blocks))
+                in_box = in_ranges(heads, head_ranges) | np.isin(heads, head_overlaps)
+                for head in heads[in_box]:
+                    if head in visited:
+                        continue
+                    visited.add(head)
+                    push_points(heap, k, blocks[head], qx, qy)
+
+            if len(heap) == k and -heap[0][0] <= radius ** 2:
+                break
+            if radius >= max_radius:
+                break
+            if len(heap) == k:
+                radius = math.ceil(math.sqrt(-heap[0][0]))
+            else:
+                radius = max(1, radius * 2)
+
+        return [(math.sqrt(-d2), (x, y, z)) for d2, x, y, z in sorted(heap, reverse=True)]
+
+    def cache_block(self, blocks, sfc_head, sfc_tail, z):
+        points = self.decode_block(sfc_head, sfc_tail, z)
+        if sfc_head in blocks:
+            points = np.vstack((blocks[sfc_head], points))
+        blocks[sfc_head] = points
+
+    def save_nn_results(self, results):
+        from psycopg2 import extras
+
+        self.cursor.execute(f"""
+            CREATE TABLE {self.name} (query_id INT, rank INT, distance DOUBLE PRECISION, point geometry(PointZ));
+        """)
+        extras.execute_values(self.cursor, f"INSERT INTO {self.name} VALUES %s",
+                              [(int(i), int(rank), float(dist), float(x), float(y), float(z))
+                               for i, rank, dist, x, y, z in results],
+                              template="(%s, %s, %s, ST_MakePoint(%s, %s, %s))", page_size=10000)
+        self.connection.commit()
+        print(f"Nearest neighbours are inserted into the table {self.name}.")
+
+    def transform_bbox(self, bbox):
+        # Scale and shift the bounding box
         x_scale, y_scale = self.scales[0], self.scales[1]
         x_offset, y_offset = self.offsets[0], self.offsets[1]
         x_min, x_max = bbox[0] * x_scale + x_offset, bbox[1] * x_scale + x_offset
         y_min, y_max = bbox[2] * x_scale + x_offset, bbox[3] * x_scale + x_offset
-        bbox = [x_min, x_max, y_min, y_max]
+        return [x_min, x_max, y_min, y_max]
+
+    def fetch_ranges(self, head_ranges, exclude=()):
+        with self.timer.stage("fetch"):
+            blocks = self.source.fetch_ranges(head_ranges, exclude)
+        self.timer.count("blocks", len(blocks))
+        self.timer.count("bytes", block_bytes(blocks))
+        return blocks
+
+    def fetch_heads(self, heads):
+        with self.timer.stage("fetch"):
+            blocks = self.source.fetch_heads(heads)
+        self.timer.count("blocks", len(blocks))
+        self.timer.count("bytes", block_bytes(blocks))
+        return blocks
+
+    def decode_block(self, sfc_head, sfc_tail, z):
+        with self.timer.stage("decode"):
+            sfc_keys = (np.int64(sfc_head) << self.tail_len) | np.asarray(sfc_tail, dtype=np.int64)
+            x, y = DecodeMorton2DArray(sfc_keys)
+            points = np.column_stack((x * self.scales[0] + self.offsets[0], y * self.scales[1] + self.offsets[1], z))
+        self.timer.count("rows", len(points))
+        return points
+
+    def server_range_search(self, bbox):
+        """
+        Same result as range_search, but the blocks are unpacked, filtered on their tail
+        ranges and decoded by PostgreSQL, so no point leaves the database.
+        """
+        from psycopg2 import extras
+        from db.server_decode import range_select_sql
+
+        bbox = self.transform_bbox(bbox)
+        source_table = self.source.point_table
+
+        # 1. Find the fully containing and overlapping heads, and the tail ranges of the
+        # overlapping heads that are in the table
+        with self.timer.stage("plan"):
+            head_ranges, head_overlaps = morton_head_range(bbox, self.head_len, self.tail_len)
+            self.cursor.execute(f"SELECT DISTINCT sfc_head FROM {source_table} WHERE sfc_head = ANY(%s)",
+                                ([int(head) for head in head_overlaps],))
+            tail_ranges = []
+            for (sfc_head,) in self.cursor.fetchall():
+                tail_rgs, tail_ols = morton_range(bbox, sfc_head, self.tail_len, 0)
+                tail_ranges.extend((sfc_head, start, end) for start, end in tail_rgs)
+
+        # 2. Decode and create the result table in the database
+        with self.timer.stage("materialize", kind="server"):
+            self.cursor.execute('DROP TABLE IF EXISTS RangeTable')
+            self.cursor.execute('''CREATE TEMP TABLE RangeTable (range_start INT, range_end INT)''')
+            extras.execute_values(self.cursor, 'INSERT INTO RangeTable (range_start, range_end) VALUES %s',
+                                  [(int(start), int(end)) for start, end in head_ranges], page_size=10000)
+            self.cursor.execute('DROP TABLE IF EXISTS TailRangeTable')
+            self.cursor.execute('''CREATE TEMP TABLE TailRangeTable (sfc_head INT, range_start INT, range_end INT)''')
+            extras.execute_values(self.cursor, 'INSERT INTO TailRangeTable VALUES %s',
+                                  [(int(head), int(start), int(end)) for head, start, end in tail_ranges], page_size=10000)
+
+            select_sql = range_select_sql(source_table, self.tail_len, self.scales, self.offsets)
+            self.cursor.execute(f"CREATE TABLE {self.name} AS {select_sql};")
+            rows = self.cursor.rowcount
+            self.connection.commit()
+        self.timer.count("rows", rows)
+        print(f"Points (original values) within the bounding box are inserted into the table {self.name}.")
+
+    def range_search(self, bbox):
+        if self.server_decode:
+            self.server_range_search(bbox)
+            return
+
+        # 0. Scale and shift the bounding box
+        bbox = self.transform_bbox(bbox)
 
         # 1. Find the fully containing and overlapping heads
-        head_ranges, head_overlaps = morton_range(bbox, 0, self.head_len, self.tail_len)
-
-        # 2. Take these heads out of the database
-        ## 2.1 Range query
-        # Create a range table and insert data
-        self.cursor.execute('DROP TABLE IF EXISTS RangeTable')
-        self.cursor.execute('''CREATE TEMP TABLE RangeTable (range_start INT, range_end INT)''')
-        self.cursor.executemany('INSERT INTO RangeTable (range_start, range_end) VALUES (%s, %s)', head_ranges)
-
-        self.cursor.execute(f'''
-            SELECT * FROM {self.source_table} 
-            WHERE EXISTS (
-                SELECT 1 FROM RangeTable 
-                WHERE {self.source_table}.sfc_head BETWEEN RangeTable.range_start AND RangeTable.range_end
-            )
-        ''')
-        res1 = self.cursor.fetchall() # data type: a list of tuple ?
-
-
-        ## 2.2 Overlaps Query
-        self.cursor.execute(f'''SELECT * FROM {self.source_table} WHERE sfc_head = ANY(%s)''', (head_overlaps,))
-        res2 = self.cursor.fetchall()
-
-        # 3. Unpack the point block and decode
-        points_within_bbox = []
-        for (sfc_head, sfc_tail, z) in res1:
-            for i in range(len(sfc_tail)):
-                sfc_key = sfc_head << self.tail_len | sfc_tail[i]
-                x, y = DecodeMorton2DX(sfc_key)*x_scale+x_offset, DecodeMorton2DY(sfc_key)*y_scale+y_offset
-                points_within_bbox.append([x, y, z[i]])
-
-        for (sfc_head, sfc_tail, z) in res2:  # Each group
-            # Check which tails of this head in within the ranges
-            tail_rgs, tail_ols = morton_range(bbox, sfc_head, self.tail_len, 0)
-            # Unpack the tails
-            for i in range(len(sfc_tail)):  # Each point
-                # Check if the tail in within the ranges
-                check_in_range = any(start <= sfc_tail[i] <= end for start, end in tail_rgs)
-                if check_in_range == 1:
-                    sfc_key = sfc_head << self.tail_len | sfc_tail[i]
-                    x, y = DecodeMorton2DX(sfc_key)*x_scale+x_offset, DecodeMorton2DY(sfc_key)*y_scale+y_offset
-                    points_within_bbox.append([x, y, z[i]])
-
-        # 4. Create results as a table
+        with self.timer.stage("plan"):
+            head_ranges, head_overlaps = morton_head_range(bbox, self.head_len, self.tail_len)
+
+        # 2. Take the blocks of these heads out of the backend and decode them; only the
+        # tails within the tail ranges are kept from the overlapping heads
+        chunks = []
+        for (sfc_head, sfc_tail, z) in self.fetch_ranges(head_ranges):
+            chunks.append(self.decode_block(sfc_head, sfc_tail, z))
+
+        for (sfc_head, sfc_tail, z) in self.fetch_heads(head_overlaps):
+            sfc_tail, z = np.asarray(sfc_tail, dtype=np.int64), np.asarray(z)
+            with self.timer.stage("plan"):
+                tail_rgs, tail_ols = morton_range(bbox, sfc_head, self.tail_len, 0)
+                mask = in_ranges(sfc_tail, tail_rgs)
+            chunks.append(self.decode_block(sfc_head, sfc_tail[mask], z[mask]))
+
+        # 3. Create results as a table
+        with self.timer.stage("materialize"):
+            self.save_points(np.vstack(chunks) if chunks else np.empty((0, 3)))
+
+    def save_points(self, points):
+        from psycopg2 import extras
+
         self.cursor.execute(f"CREATE TABLE {self.name} (point geometry(PointZ));")
-        insert_sql = f"INSERT INTO {self.name} VALUES (ST_MakePoint(%s, %s, %s));"
-        for point in points_within_bbox:
-            self.cursor.execute(insert_sql, point)
+        extras.execute_values(self.cursor, f"INSERT INTO {self.name} VALUES %s",
+                              [(float(x), float(y), float(z)) for x, y, z in points],
+                              template="(ST_MakePoint(%s, %s, %s))", page_size=10000)
         self.connection.commit()
         print(f"Points (original values) within the bounding box are inserted into the table {self.name}.")
 
     def disconnect(self):
-        if self.connection:
-            self.cursor.close()
-            self.connection.close()
-            self.connection = None
-            self.cursor = None
+        if self.source is not self.db:
+            self.source.disconnect()
+        if self.owns_connection:
+            self.db.disconnect()
+        self.connection = None
+        self.cursor = None
+
+
+class LocalQuerier(Querier):
+    def __init__(self, query_name, source_name, db_conf, store=None):
+        """
+        Run the same queries as Querier against a local BlockStore instead of PostgreSQL.
+        The result is kept in memory as an (n, 3) array and saved to {query_name}.npy on disconnect.
+        An already mapped store can be passed to reuse it; it is left open by disconnect().
+        """
+        self.points = np.empty((0, 3))
+        self.query_ids = None
+        super().__init__(query_name, source_name, dict(db_conf, server_decode=False), connection=store)
+
+    def open_backend(self, db_conf, source_name, connection=None):
+        from db.block_store import BlockStore
+
+        if connection is not None:
+            return connection
+        store = BlockStore(db_conf, source_name)
+        store.connect()
+        return store
+
+    def drop_result_table(self):
+        self.points = np.empty((0, 3))
+        self.query_ids = None
+
+    def result_count(self):
+        return len(self.points)
+
+    def refine_circle(self, center_x, center_y, radius):
+        dist2 = (self.points[:, 0] - center_x) ** 2 + (self.points[:, 1] - center_y) ** 2
+        self.keep(dist2 <= radius ** 2)
+
+    def refine_polygon(self, polygon, wkt_string):
+        self.keep(contains_xy(polygon, self.points[:, 0], self.points[:, 1]))
+
+    def refine_z(self, maxz=None, minz=None):
+        if maxz is not None:
+            self.keep(self.points[:, 2] <= maxz)
+        if minz is not None:
+            self.keep(self.points[:, 2] >= minz)
+
+    def save_points(self, points):
+        self.points = points
+        print(f"{len(self.points)} points (original values) within the bounding box are found.")
+
+    def save_nn_results(self, results):
+        self.points = np.array([result[3:] for result in results]).reshape(-1, 3)
+        self.query_ids = np.array([result[0] for result in results], dtype=np.int64)
+
+    def save_multi_results(self, query_ids, points):
+        self.points = points
+        self.query_ids = query_ids
+
+    def keep(self, mask):
+        self.points = self.points[mask]
+        if self.query_ids is not None:
+            self.query_ids = self.query_ids[mask]
+
+    def disconnect(self):
+        np.save(f"{self.name}.npy", self.points)
+        if self.query_ids is not None:
+            np.save(f"{self.name}_query_id.npy", self.query_ids)
+        super().disconnect()
+
+
+def contains_xy(geometry, x, y):
+    # Vectorized point-in-polygon, shapely.contains_xy from shapely 2 or shapely.vectorized before
+    try:
+        from shapely import contains_xy as shapely_contains_xy
+    except ImportError:
+        from shapely.vectorized import contains as shapely_contains_xy
+    return shapely_contains_xy(geometry, x, y)
+
+
+def geometry_bbox(mode, geometry):
+    if mode == "bbox":
+        return list(geometry)
+    elif mode == "circle":
+        (center_x, center_y), radius = geometry
+        return [center_x - radius, center_x + radius, center_y - radius, center_y + radius]
+    elif mode == "polygon":
+        from shapely.wkt import loads
+        x_min, y_min, x_max, y_max = loads(geometry).bounds
+        return [x_min, x_max, y_min, y_max]
+    elif mode == "nn":
+        points = geometry[0] if isinstance(geometry[0][0], (list, tuple)) else [geometry[0]]
+        x = [pt[0] for pt in points]
+        y = [pt[1] for pt in points]
+        return [min(x), max(x), min(y), max(y)]
+    elif mode == "multi":
+        bboxes = [geometry_bbox(sub_mode, sub_geometry) for sub_mode, sub_geometry in geometry]
+        return [min(b[0] for b in bboxes), max(b[1] for b in bboxes),
+                min(b[2] for b in bboxes), max(b[3] for b in bboxes)]
+    raise ValueError(f"Unsupported mode: {mode}")
+
+
+def choose_lod(levels, point_count, bbox, query_bbox, max_points, scale=1):
+    """
+    The smallest depth, 0 for the full points, whose expected number of points within
+    query_bbox is at most max_points; the coarsest level when none is. The expectation
+    assumes a uniform density over the dataset bbox, and a level never has more points
+    than Morton cells in query_bbox.
+    """
+    width = max(min(bbox[1], query_bbox[1]) - max(bbox[0], query_bbox[0]), 0)
+    height = max(min(bbox[3], query_bbox[3]) - max(bbox[2], query_bbox[2]), 0)
+    fraction = min(width * height / (max(bbox[1] - bbox[0], 1) * max(bbox[3] - bbox[2], 1)), 1)
+
+    counts = dict(levels)
+    counts[0] = point_count
+    for depth in sorted(counts):
+        expected = counts[depth] * fraction
+        if depth > 0:
+            cell = 2 ** depth * scale
+            expected = min(expected, (math.ceil(width / cell) + 1) * (math.ceil(height / cell) + 1))
+        if expected <= max_points:
+            return depth
+    return max(counts)
+
+
+def block_bytes(blocks):
+    # Size of the heads and tails (INT) and z values (DOUBLE PRECISION) of fetched blocks
+    return sum(4 + 4 * len(sfc_tail) + 8 * len(z) for (_, sfc_tail, z) in blocks)
+
+
+def make_shape(mode, geometry):
+    """
+    Returns:
+        tuple: (mode, bbox, parameters of the exact test)
+    """
+    if mode == "bbox":
+        return mode, list(geometry), None
+    elif mode == "circle":
+        (center_x, center_y), radius = geometry
+        return mode, [center_x - radius, center_x + radius, center_y - radius, center_y + radius], (center_x, center_y, radius)
+    elif mode == "polygon":
+        from shapely.wkt import loads
+
+        polygon = loads(geometry)
+        x_min, y_min, x_max, y_max = polygon.bounds
+        return mode, [x_min, x_max, y_min, y_max], polygon
+    raise ValueError(f"Unsupported mode in multi query: {mode}")
+
+
+class BlockIndex:
+    def __init__(self, blocks):
+        """
+        Positions of the points of fetched blocks, once they are decoded and stacked in
+        the order of blocks, looked up by head with binary searches.
+        """
+        heads = np.array([sfc_head for (sfc_head, _, _) in blocks], dtype=np.int64)
+        sizes = np.array([len(z) for (_, _, z) in blocks], dtype=np.int64)
+        self.order = np.argsort(heads, kind="stable")
+        self.heads = heads[self.order]
+        self.starts = (np.cumsum(sizes) - sizes)[self.order]
+        self.sizes = sizes[self.order]
+
+    def points(self, head_ranges, heads):
+        """
+        Returns:
+            np.ndarray: the positions of the points of the blocks whose head is in one of
+            head_ranges or in heads
+        """
+        ranges = np.asarray(head_ranges, dtype=np.int64).reshape(-1, 2)
+        heads = np.asarray(heads, dtype=np.int64)
+        lows = np.concatenate((np.searchsorted(self.heads, ranges[:, 0], side="left"),
+                               np.searchsorted(self.heads, heads, side="left")))
+        highs = np.concatenate((np.searchsorted(self.heads, ranges[:, 1], side="right"),
+                                np.searchsorted(self.heads, heads, side="right")))
+        selected = [np.arange(low, high) for low, high in zip(lows, highs) if high > low]
+        if not selected:
+            return np.empty(0, dtype=np.int64)
+        selected = np.unique(np.concatenate(selected))
+        return np.concatenate([np.arange(start, start + size)
+                               for start, size in zip(self.starts[selected], self.sizes[selected])])
+
+
+def shape_contains(shape, x, y):
+    mode, bbox, parameters = shape
+    mask = (x >= bbox[0]) & (x <= bbox[1]) & (y >= bbox[2]) & (y <= bbox[3])
+    if mode == "circle":
+        center_x, center_y, radius = parameters
+        mask &= (x - center_x) ** 2 + (y - center_y) ** 2 <= radius ** 2
+    elif mode == "polygon":
+        mask[mask] = contains_xy(parameters, x[mask], y[mask])
+    return mask
+
+
+def merge_ranges(ranges):
+    """
+    Union of [start, end] ranges, sorted and without overlapping or adjacent ranges.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def push_points(heap, k, points, qx, qy):
+    """
+    Push the points of a block into the bounded max-heap of the k nearest points.
+    """
+    d2 = (points[:, 0] - qx) ** 2 + (points[:, 1] - qy) ** 2
+    if len(heap) == k:
+        candidates = np.flatnonzero(d2 < -heap[0][0])
+    else:
+        candidates = np.arange(len(d2))
+
+    for j in candidates[np.argsort(d2[candidates], kind="stable")]:
+        item = (-d2[j], points[j, 0], points[j, 1], points[j, 2])
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif d2[j] < -heap[0][0]:
+            heapq.heappushpop(heap, item)
+        else:
+            break
+
+
+def in_ranges(values, ranges):
+    """
+    Vectorized version of any(start <= v <= end for start, end in ranges) for disjoint ranges.
+    """
+    if len(ranges) == 0:
+        return np.zeros(len(values), dtype=bool)
+    ranges = np.asarray(ranges, dtype=np.int64)
+    ranges = ranges[np.argsort(ranges[:, 0])]
+    idx = np.searchsorted(ranges[:, 0], values, side="right") - 1
+    return (idx >= 0) & (values <= ranges[np.maximum(idx, 0), 1])
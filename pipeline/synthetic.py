@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import laspy
+from pipeline.retrieve_data import geometry_bbox
+
+
+def query_extent(queries, margin=50):
+    """
+    Bounding box [x_min, x_max, y_min, y_max] of all the geometries of a query suite,
+    grouped by source dataset.
+    """
+    extents = {}
+    for value in queries.values():
+        bbox = geometry_bbox(value["mode"], value["geometry"])
+        old = extents.get(value["source_dataset"], bbox)
+        extents[value["source_dataset"]] = [min(old[0], bbox[0]), max(old[1], bbox[1]),
+                                            min(old[2], bbox[2]), max(old[3], bbox[3])]
+    return {name: [b[0] - margin, b[1] + margin, b[2] - margin, b[3] + margin] for name, b in extents.items()}
+
+
+def generate_las(path, bbox, point_count, seed=0):
+    """
+    Write a LAS file with point_count points spread uniformly over bbox, with a smooth
+    terrain and some noise as z, so that the benchmarks can run without the AHN files.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(bbox[0], bbox[1], point_count)
+    y = rng.uniform(bbox[2], bbox[3], point_count)
+    z = 5 * np.sin(x / 50) + 5 * np.cos(y / 70) + rng.normal(0, 0.5, point_count)
+
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.offsets = np.array([0, 0, 0])
+    header.scales = np.array([0.01, 0.01, 0.01])
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with laspy.open(path, mode="w", header=header) as writer:
+        point_record = laspy.ScaleAwarePointRecord.zeros(point_count, header=header)
+        point_record.x = x
+        point_record.y = y
+        point_record.z = z
+        writer.write_points(point_record)
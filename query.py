@@ -3,12 +3,21 @@ import json
 import time
 import argparse
 
-from pipeline.retrieve_data import Querier
+from pipeline.retrieve_data import Querier, LocalQuerier
+from pcsfc import instrument
 
 def main():
     parser = argparse.ArgumentParser(description='Example of argparse usage.')
     parser.add_argument('--input', type=str, default="./scripts/query_20m.json", help='Input parameter json file path.')
     parser.add_argument('--password', type=str, default="123456", help='Input parameter json file path.')
+    parser.add_argument('--backend', type=str, default="postgres", choices=["postgres", "local"], help='Storage backend.')
+    parser.add_argument('--store', type=str, default="./store", help='Root directory of the local block store.')
+    parser.add_argument('--server-decode', action='store_true', help='Decode the points inside PostgreSQL.')
+    parser.add_argument('--log', action='store_true', help='Emit spans and counters as structured log lines.')
+    parser.add_argument('--metrics', type=str, default=None, help='Append spans and counters as JSON lines to this file.')
+    parser.add_argument('--cprofile', type=str, default=None, help='Run under cProfile and write the stats to this file.')
+    parser.add_argument('--serve', type=int, default=None, help='Run a query server on this port instead of the queries in --input.')
+    parser.add_argument('--host', type=str, default="localhost", help='Host of the query server. Requests are not authenticated, keep it local.')
     args = parser.parse_args()
     #jparams_path = "./scripts/query_20m_local.json"
     jparams_path = args.input
@@ -24,25 +33,46 @@ def main():
 
     db_conf = jparams["config"]
     db_conf["password"] = args.password
+    db_conf["backend"] = args.backend
+    db_conf["store_dir"] = args.store
+    db_conf["server_decode"] = args.server_decode
+    instrument.configure(log=args.log, metrics_file=args.metrics)
 
-    for key, value in jparams["queries"].items():
+    if args.serve:
+        from pipeline.query_server import QueryServer
+        QueryServer(db_conf).serve(args.host, args.serve)
+        return
+
+    with instrument.profiling(args.cprofile):
+        run_queries(jparams["queries"], db_conf)
+
+
+def run_queries(queries, db_conf):
+    for key, value in queries.items():
         start_time = time.time()
         query_name, source_name, mode, geometry = key, value["source_dataset"], value["mode"], value["geometry"]
         print(f"=== {mode} query {key} from {source_name} ===")
 
-        try:
-            pipeline = Querier(query_name, source_name, db_conf)
-            pipeline.geometry_query(mode, geometry)
+        with instrument.context(query=key, mode=mode, source=source_name):
+            try:
+                if db_conf["backend"] == "local":
+                    pipeline = LocalQuerier(query_name, source_name, db_conf)
+                else:
+                    pipeline = Querier(query_name, source_name, db_conf)
+                pipeline.select_lod(mode, geometry, value.get("lod"), value.get("max_points"))
+                pipeline.geometry_query(mode, geometry)
 
-            if "maxz" in value:
-                pipeline.maxz_query(value["maxz"])
-            if "minz" in value:
-                pipeline.minz_query(value["minz"])
+                if "maxz" in value:
+                    pipeline.maxz_query(value["maxz"])
+                if "minz" in value:
+                    pipeline.minz_query(value["minz"])
 
-            pipeline.disconnect()
-        except Exception as e:
-            print(f"An error occurred: {e}")
+                pipeline.disconnect()
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                instrument.error("query", e)
 
+            instrument.flush_counters()
         print("-->%ss" % round(time.time() - start_time, 2))
 
 
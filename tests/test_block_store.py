@@ -0,0 +1,88 @@
+import numpy as np
+
+from db.block_store import BlockStore
+
+
+def write_csv(path, blocks):
+    # The format of PointProcessor.write_csv
+    with open(path, "w") as f:
+        f.write("sfc_head,sfc_tail,z\n")
+        for head, tails, z in blocks:
+            f.write(f'{head},"{{{",".join(map(str, tails))}}}","{{{",".join(map(str, z))}}}"\n')
+
+
+def stored_blocks(store):
+    return [(head, tails.tolist(), z.tolist()) for head, tails, z in
+            (store.block(i) for i in range(len(store.heads)))]
+
+
+def test_append_merges_blocks_with_the_same_head(tmp_path):
+    store = BlockStore({"store_dir": str(tmp_path)}, "t")
+    store.create_table()
+    write_csv(tmp_path / "a.csv", [(1, [2, 5], [0.2, 0.5]), (3, [1], [3.1]), (7, [4], [7.4])])
+    store.copy_points(str(tmp_path / "a.csv"))
+    store.create_btree_index()
+
+    write_csv(tmp_path / "b.csv", [(3, [0, 4], [3.0, 3.4]), (5, [9], [5.9])])
+    write_csv(tmp_path / "c.csv", [(3, [2], [3.2]), (8, [1], [8.1])])
+    store.stage_points(str(tmp_path / "b.csv"))
+    store.stage_points(str(tmp_path / "c.csv"))
+    store.merge_staging()
+
+    assert stored_blocks(store) == [
+        (1, [2, 5], [0.2, 0.5]),
+        (3, [0, 1, 2, 4], [3.0, 3.1, 3.2, 3.4]),
+        (5, [9], [5.9]),
+        (7, [4], [7.4]),
+        (8, [1], [8.1]),
+    ]
+    assert store.offsets.tolist() == [0, 2, 6, 7, 8, 9]
+    assert [head for head, _, _ in store.fetch_ranges([[2, 6]])] == [3, 5]
+
+
+def random_blocks(rng, heads, tail_len):
+    blocks = []
+    for head in heads:
+        tails = np.unique(rng.integers(0, 1 << tail_len, rng.integers(1, 6)))
+        blocks.append((int(head), tails.tolist(), rng.random(len(tails)).round(3).tolist()))
+    return blocks
+
+
+def brute_force_lod(store, depth, tail_len):
+    keys = np.array([(head << tail_len) | tail for head, tails, _ in stored_blocks(store) for tail in tails])
+    z = np.array([value for _, _, values in stored_blocks(store) for value in values])
+    _, first = np.unique(keys >> (2 * depth), return_index=True)
+    return keys[first].tolist(), z[first].tolist()
+
+
+def lod_points(store, depth, tail_len):
+    level = store.open_lod(depth)
+    blocks = stored_blocks(level)
+    return ([(head << tail_len) | tail for head, tails, _ in blocks for tail in tails],
+            [value for _, _, values in blocks for value in values])
+
+
+def test_lod_after_append_equals_a_rebuild(tmp_path, monkeypatch):
+    # Small chunks, so the streaming build crosses chunk boundaries
+    monkeypatch.setattr("db.block_store.LOD_CHUNK_BLOCKS", 3)
+    rng = np.random.default_rng(7)
+    tail_len, depths = 4, [1, 2, 3]
+    store = BlockStore({"store_dir": str(tmp_path)}, "t")
+    store.create_table()
+    store.insert_metadata(["t", 28992, 0, 6, tail_len, [1, 1, 1], [0, 0, 0], [0, 0, 0, 0, 0, 0]])
+    write_csv(tmp_path / "a.csv", random_blocks(rng, range(0, 40, 2), tail_len))
+    store.copy_points(str(tmp_path / "a.csv"))
+    store.create_btree_index()
+    store.build_lod(depths)
+
+    write_csv(tmp_path / "b.csv", random_blocks(rng, [3, 4, 17, 41], tail_len))
+    store.stage_points(str(tmp_path / "b.csv"))
+    store.merge_staging()
+    store.build_lod(depths, heads=store.merged_heads)
+
+    appended = {depth: lod_points(store, depth, tail_len) for depth in depths}
+    counts = store.read_lod()
+    store.build_lod(depths)
+    for depth in depths:
+        assert appended[depth] == lod_points(store, depth, tail_len) == brute_force_lod(store, depth, tail_len)
+    assert counts == store.read_lod()
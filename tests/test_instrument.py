@@ -0,0 +1,27 @@
+import json
+
+from pcsfc import instrument
+
+
+def test_stages_are_emitted_once_per_flush(tmp_path):
+    metrics = tmp_path / "metrics.jsonl"
+    instrument.flush_counters()  # drop what earlier tests accumulated, nothing is emitted yet
+    instrument.configure(metrics_file=str(metrics))
+    try:
+        timer = instrument.StageTimer()
+        with instrument.context(query="q"):
+            for _ in range(100):
+                with timer.stage("decode"):
+                    timer.count("blocks")
+            with timer.stage("refine", kind="circle"):
+                pass
+            instrument.flush_counters()
+    finally:
+        instrument.close()
+
+    events = [json.loads(line) for line in metrics.read_text().splitlines()]
+    spans = {event["name"]: event for event in events if event["type"] == "span"}
+    assert len(events) == 3
+    assert spans["decode"]["calls"] == 100 and spans["decode"]["query"] == "q"
+    assert spans["refine"]["kind"] == "circle"
+    assert [event["counters"] for event in events if event["type"] == "counters"] == [{"blocks": 100}]
@@ -0,0 +1,37 @@
+import pytest
+
+from db.backend import check_table_name, check_dataset_name
+from pipeline.query_server import QueryServer
+
+
+@pytest.mark.parametrize("name", ["B12_L_RECT", "meter_A1_S_RCT", "_q"])
+def test_valid_query_names(name):
+    assert check_table_name(name) == name
+
+
+@pytest.mark.parametrize("name", ["x; DROP TABLE t", "../x", "1abc", "", "a b", None])
+def test_invalid_query_names(name):
+    with pytest.raises(ValueError):
+        check_table_name(name)
+
+
+def test_dataset_names_may_start_with_a_digit():
+    assert check_dataset_name("23090m") == "23090m"
+    with pytest.raises(ValueError):
+        check_dataset_name("t/../../x")
+
+
+@pytest.mark.parametrize("request_body", [
+    {"name": "x; DROP TABLE t", "source_dataset": "t", "mode": "bbox", "geometry": [0, 1, 0, 1]},
+    {"name": "q", "source_dataset": "t'--", "mode": "bbox", "geometry": [0, 1, 0, 1]},
+    {"name": "q", "source_dataset": "t", "mode": "drop", "geometry": [0, 1, 0, 1]},
+    {"name": "q", "source_dataset": "t", "mode": "bbox", "geometry": [0, 1, 0, 1], "maxz": "1; DROP TABLE t"},
+    {"queries": {"ok": {"source_dataset": "t", "mode": "bbox", "geometry": [0, 1, 0, 1]},
+                 "../x": {"source_dataset": "t", "mode": "bbox", "geometry": [0, 1, 0, 1]}}},
+    [1, 2],
+])
+def test_invalid_requests_are_rejected_before_running(request_body):
+    server = QueryServer({"backend": "local", "store_dir": "/nonexistent"})
+    server.run = lambda name, value: pytest.fail("an invalid request was run")
+    with pytest.raises((ValueError, TypeError)):
+        server.handle(request_body)
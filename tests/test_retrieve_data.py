@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from db.block_store import BlockStore
+from pcsfc.encoder import EncodeMorton2D
+from pipeline.retrieve_data import LocalQuerier, merge_ranges, in_ranges, push_points, choose_lod
+
+HEAD_LEN, TAIL_LEN = 12, 10
+
+
+def make_store(store_dir, points):
+    """
+    Block store of the dataset "t" holding the points, split with HEAD_LEN / TAIL_LEN.
+    """
+    keys = np.array([EncodeMorton2D(int(x), int(y)) for x, y, _ in points], dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    keys, z = keys[order], points[order, 2]
+    heads = keys >> TAIL_LEN
+    starts = np.flatnonzero(np.concatenate(([True], heads[1:] != heads[:-1])))
+
+    db_conf = {"store_dir": str(store_dir)}
+    store = BlockStore(db_conf, "t")
+    store.create_table()
+    store.insert_metadata(["t", 28992, len(points), HEAD_LEN, TAIL_LEN, [1, 1, 1], [0, 0, 0],
+                           [0, 1000, 0, 1000, 0, 100]])
+    store.write_columns(heads[starts].astype(np.int32), np.append(starts, len(keys)).astype(np.int64),
+                        (keys & ((1 << TAIL_LEN) - 1)).astype(np.int32), z)
+    store.disconnect()
+    return db_conf
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(1)
+    return np.column_stack((rng.integers(0, 1000, 500), rng.integers(0, 1000, 500),
+                            rng.uniform(0, 100, 500))).astype(np.float64)
+
+
+def brute_force_knn(points, qx, qy, k):
+    return np.sort(np.sqrt((points[:, 0] - qx) ** 2 + (points[:, 1] - qy) ** 2))[:k]
+
+
+@pytest.mark.parametrize("qx, qy, k", [(500, 500, 1), (10, 990, 8), (733.5, 120.2, 25), (-50, 500, 3)])
+def test_knn_matches_brute_force(tmp_path, points, qx, qy, k):
+    querier = LocalQuerier("q", "t", make_store(tmp_path, points))
+    distances = [dist for dist, _ in querier.knn(qx, qy, k, {})]
+    assert np.allclose(distances, brute_force_knn(points, qx, qy, k))
+
+
+def test_knn_with_k_larger_than_point_count(tmp_path, points):
+    querier = LocalQuerier("q", "t", make_store(tmp_path, points[:20]))
+    distances = [dist for dist, _ in querier.knn(400, 400, 50, {})]
+    assert np.allclose(distances, brute_force_knn(points[:20], 400, 400, 50))
+
+
+def test_nn_batch_shares_blocks(tmp_path, points):
+    querier = LocalQuerier("q", "t", make_store(tmp_path, points))
+    querier.nn_query([[[100, 100], [900, 900]], 4])
+    assert querier.query_ids.tolist() == [0] * 4 + [1] * 4
+    for i, (qx, qy) in enumerate([(100, 100), (900, 900)]):
+        found = querier.points[querier.query_ids == i]
+        distances = np.sqrt((found[:, 0] - qx) ** 2 + (found[:, 1] - qy) ** 2)
+        assert np.allclose(distances, brute_force_knn(points, qx, qy, 4))
+
+
+def test_push_points_keeps_the_k_nearest():
+    heap = []
+    push_points(heap, 3, np.array([[3.0, 0, 1], [1.0, 0, 2], [5.0, 0, 3]]), 0, 0)
+    push_points(heap, 3, np.array([[2.0, 0, 4], [4.0, 0, 5]]), 0, 0)
+    assert sorted(-d2 for d2, _, _, _ in heap) == [1, 4, 9]
+
+
+def test_merge_ranges():
+    assert merge_ranges([]) == []
+    assert merge_ranges([[5, 7], [1, 2]]) == [[1, 2], [5, 7]]
+    # Adjacent ranges are joined
+    assert merge_ranges([[1, 2], [3, 4]]) == [[1, 4]]
+    # Overlapping and contained ranges are joined
+    assert merge_ranges([[1, 5], [4, 8], [2, 3], [10, 12]]) == [[1, 8], [10, 12]]
+
+
+def test_in_ranges():
+    values = np.array([0, 1, 2, 5, 6, 9, 10, 11])
+    assert in_ranges(values, [[9, 10], [1, 2]]).tolist() == [False, True, True, False, False, True, True, False]
+    assert not in_ranges(values, []).any()
+
+
+def test_choose_lod():
+    levels = {2: 10000, 4: 1000, 6: 100}
+    bbox = [0, 1000, 0, 1000]
+    # The whole dataset: the most detailed level that fits
+    assert choose_lod(levels, 100000, bbox, bbox, 200000) == 0
+    assert choose_lod(levels, 100000, bbox, bbox, 5000) == 4
+    # A quarter of the dataset holds a quarter of the points
+    assert choose_lod(levels, 100000, bbox, [0, 500, 0, 500], 2500) == 2
+    # Nothing fits: the coarsest level
+    assert choose_lod(levels, 100000, bbox, bbox, 10) == 6
+
+
+def test_multi_query_matches_single_queries(tmp_path, points):
+    db_conf = make_store(tmp_path, points)
+    geometries = [["bbox", [100, 300, 200, 450]], ["circle", [[600, 600], 120]], ["bbox", [250, 400, 400, 500]]]
+    querier = LocalQuerier("q", "t", db_conf)
+    querier.multi_query(geometries)
+
+    for i, (mode, geometry) in enumerate(geometries):
+        single = LocalQuerier("q", "t", db_conf)
+        single.geometry_query(mode, geometry)
+        found = querier.points[querier.query_ids == i]
+        assert sorted(map(tuple, found)) == sorted(map(tuple, single.points))
@@ -0,0 +1,19 @@
+import numpy as np
+
+from db.server_decode import compact_sql
+from pcsfc.encoder import EncodeMorton2D
+from pcsfc.decoder import DecodeMorton2DX, DecodeMorton2DY
+
+
+def test_compact_sql_matches_the_decoder():
+    # The SQL expression only uses >>, & and |, so it can be evaluated as Python
+    decode_x = eval("lambda sfc_key: " + compact_sql("sfc_key", 0))
+    decode_y = eval("lambda sfc_key: " + compact_sql("sfc_key", 1))
+
+    rng = np.random.default_rng(0)
+    coordinates = [(0, 0), (1, 0), (0, 1), ((1 << 31) - 1, (1 << 31) - 1)]
+    coordinates += [tuple(pt) for pt in rng.integers(0, 1 << 31, (1000, 2)).tolist()]
+    for x, y in coordinates:
+        sfc_key = int(EncodeMorton2D(x, y))
+        assert decode_x(sfc_key) == DecodeMorton2DX(sfc_key) == x
+        assert decode_y(sfc_key) == DecodeMorton2DY(sfc_key) == y